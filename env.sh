@@ -2,3 +2,5 @@
 
 export ES_HOST="localhost"
 export ES_PORT=9200
+export ES_REFRESH_POLICY="none"
+export ES_MAXSIZE=10
@@ -1,3 +1,5 @@
 class Base(object):
+    __slots__ = ()
+
     def __init__(self, **kwargs):
         pass
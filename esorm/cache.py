@@ -0,0 +1,154 @@
+import collections
+import threading
+import time
+
+from esorm.config import elasticsearch_config
+from esorm.util import serialization_util
+
+
+class EntityCache(object):
+    """
+    In-process cache of the documents read from elasticsearch, keyed by (class name, uid, version).
+    The current document of an entity is stored with the version None and expires after the TTL,
+    version documents never change and only leave the cache when evicted.
+    Least recently used documents are evicted beyond max_entries documents or max_bytes of JSON.
+    Documents are stored serialized, every read getting its own copy
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, ttl=None):
+        """
+        :param max_entries: maximum number of documents, defaults to the configured number
+        :param max_bytes: maximum size of the documents serialized to JSON, defaults to the configured size
+        :param ttl: seconds before a current document expires, defaults to the configured TTL
+        """
+        self.max_entries = elasticsearch_config.CACHE_MAX_ENTRIES if max_entries is None else max_entries
+        self.max_bytes = elasticsearch_config.CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.ttl = elasticsearch_config.CACHE_TTL if ttl is None else ttl
+
+        # key -> (serialized document, expiry time or None), in least recently used order
+        self._entries = collections.OrderedDict()
+        # (class name, uid) -> keys of the cached documents of the entity
+        self._keys_by_entity = collections.defaultdict(set)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, class_name, uid, version=None):
+        """
+        :return: cached document ({"_source": ..., "_version": ...}), None if not cached or expired
+        """
+        key = (class_name, uid, version)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] < time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return serialization_util.get_serializer().loads(entry[0])
+
+    def set(self, class_name, uid, document, version=None):
+        """
+        Caches a document, the current document of the entity when version is None
+        :param document: {"_source": ..., "_version": ...}
+        """
+        key = (class_name, uid, version)
+        serialized = serialization_util.get_serializer().dumps_bytes(document)
+        if len(serialized) > self.max_bytes:
+            return
+        expiry = time.time() + self.ttl if version is None else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (serialized, expiry)
+            self._keys_by_entity[(class_name, uid)].add(key)
+            self._bytes += len(serialized)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        serialized, expiry = self._entries.pop(key)
+        self._bytes -= len(serialized)
+        entity_key = key[:2]
+        entity_keys = self._keys_by_entity[entity_key]
+        entity_keys.discard(key)
+        if not entity_keys:
+            del self._keys_by_entity[entity_key]
+
+    def invalidate(self, class_name, uid, version=None, all_versions=False):
+        """
+        Removes the current document of an entity, or one of its versions,
+        or all its documents with all_versions
+        """
+        with self._lock:
+            if all_versions:
+                keys = list(self._keys_by_entity.get((class_name, uid), ()))
+            else:
+                keys = [(class_name, uid, version)]
+            for key in keys:
+                if key in self._entries:
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_entity.clear()
+            self._bytes = 0
+
+    def get_stats(self):
+        """
+        :return: <dict> of the hits, misses, evictions, number of documents and bytes of the cache
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._entries),
+                    'bytes': self._bytes}
+
+
+_cache = None
+# Set once the cache was enabled or disabled explicitly, the configuration being ignored afterwards
+_configured = False
+_cache_lock = threading.Lock()
+
+
+def enable_cache(**options):
+    """
+    Enables the cache shared by the process, replacing the current one
+    :param options: see EntityCache
+    :return: EntityCache
+    """
+    global _cache, _configured
+    with _cache_lock:
+        _cache = EntityCache(**options)
+        _configured = True
+    return _cache
+
+
+def disable_cache():
+    global _cache, _configured
+    with _cache_lock:
+        _cache = None
+        _configured = True
+
+
+def get_cache():
+    """
+    Cache shared by the process, created on first use when enabled by the configuration
+    :return: EntityCache, None when disabled
+    """
+    global _cache, _configured
+    if not _configured:
+        with _cache_lock:
+            if not _configured:
+                _cache = EntityCache() if elasticsearch_config.CACHE_ENABLED else None
+                _configured = True
+    return _cache
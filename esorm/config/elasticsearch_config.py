@@ -6,3 +6,69 @@ INDEX = 'orm'
 TYPE = 'entity'
 VERSIONING_INDEX = 'version'
 VERSIONING_TYPE = 'orm_entity'
+# Time partitioning of the versions: "none" writes them into VERSIONING_INDEX, "year", "month" or "day"
+# into VERSIONING_INDEX-YYYY, VERSIONING_INDEX-YYYY.MM or VERSIONING_INDEX-YYYY.MM.DD indices read through the alias
+VERSIONING_PARTITION = os.getenv('ES_VERSIONING_PARTITION', 'none')
+VERSIONING_ALIAS = os.getenv('ES_VERSIONING_ALIAS', 'versions')
+
+# Refresh policy applied to writes, one of "none", "wait_for" or "immediate"
+REFRESH_POLICY = os.getenv('ES_REFRESH_POLICY', 'none')
+
+# Connection settings of the client shared by the whole process
+TIMEOUT = int(os.getenv('ES_TIMEOUT', 3000))
+# Maximum number of connections kept open per elasticsearch node
+MAXSIZE = int(os.getenv('ES_MAXSIZE', 10))
+KEEP_ALIVE = os.getenv('ES_KEEP_ALIVE', 'true').lower() == 'true'
+SNIFF_ON_START = os.getenv('ES_SNIFF_ON_START', 'false').lower() == 'true'
+SNIFF_ON_CONNECTION_FAIL = os.getenv('ES_SNIFF_ON_CONNECTION_FAIL', 'false').lower() == 'true'
+# Seconds between two sniffs of the cluster nodes, sniffing is disabled when not set
+SNIFFER_TIMEOUT = float(os.getenv('ES_SNIFFER_TIMEOUT')) if os.getenv('ES_SNIFFER_TIMEOUT') else None
+
+# Bounds of a single _bulk request
+BULK_CHUNK_SIZE = int(os.getenv('ES_BULK_CHUNK_SIZE', 500))
+BULK_MAX_CHUNK_BYTES = int(os.getenv('ES_BULK_MAX_CHUNK_BYTES', 10 * 1024 * 1024))
+# Number of threads sending _bulk requests
+BULK_THREAD_COUNT = int(os.getenv('ES_BULK_THREAD_COUNT', 1))
+# Retries of the bulk actions rejected with 429, with exponential backoff in seconds
+BULK_MAX_RETRIES = int(os.getenv('ES_BULK_MAX_RETRIES', 3))
+BULK_INITIAL_BACKOFF = float(os.getenv('ES_BULK_INITIAL_BACKOFF', 2))
+BULK_MAX_BACKOFF = float(os.getenv('ES_BULK_MAX_BACKOFF', 600))
+
+# Number of documents fetched per request when iterating over search results
+SEARCH_PAGE_SIZE = int(os.getenv('ES_SEARCH_PAGE_SIZE', 1000))
+# Number of documents fetched per _mget request when getting entities by uid
+MGET_CHUNK_SIZE = int(os.getenv('ES_MGET_CHUNK_SIZE', 1000))
+# Maximum from + size of a single search request (index.max_result_window)
+MAX_RESULT_WINDOW = int(os.getenv('ES_MAX_RESULT_WINDOW', 10000))
+
+# Seconds before the allowed values of a property loaded from a URL are refreshed in the background
+ALLOWED_VALUES_TTL = float(os.getenv('ES_ALLOWED_VALUES_TTL', 300))
+# Timeout in seconds of the requests fetching the allowed values
+ALLOWED_VALUES_TIMEOUT = float(os.getenv('ES_ALLOWED_VALUES_TIMEOUT', 5))
+# Directory of the last fetched allowed values, used when the URL cannot be reached. Defaults to a directory
+# of the user's cache, which other users cannot write to, an empty value disabling the snapshots
+ALLOWED_VALUES_SNAPSHOT_DIR = os.getenv('ES_ALLOWED_VALUES_SNAPSHOT_DIR', os.path.join(
+    os.getenv('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'esorm', 'allowed_values'))
+
+# Checks that the values of JsonObjectProperty can be serialized to JSON, can be disabled in production
+CHECK_JSON = os.getenv('ES_CHECK_JSON', 'true').lower() == 'true'
+
+# JSON library of the requests, responses and content hashes, "auto" picking orjson, then ujson, then json
+JSON_LIBRARY = os.getenv('ES_JSON_LIBRARY', 'auto')
+
+# In-process cache of the documents read by uid, disabled by default
+CACHE_ENABLED = os.getenv('ES_CACHE_ENABLED', 'false').lower() == 'true'
+CACHE_MAX_ENTRIES = int(os.getenv('ES_CACHE_MAX_ENTRIES', 10000))
+CACHE_MAX_BYTES = int(os.getenv('ES_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+# Seconds before a cached current document expires, version documents never expire
+CACHE_TTL = float(os.getenv('ES_CACHE_TTL', 60))
+
+# Retention of the versions applied to the entity classes without retention policy, all versions being kept by default:
+# number of latest versions kept, seconds during which versions are kept,
+# and seconds of the periods one older version is kept for
+VERSION_KEEP_LAST = int(os.getenv('ES_VERSION_KEEP_LAST')) if os.getenv('ES_VERSION_KEEP_LAST') else None
+VERSION_KEEP_FOR = float(os.getenv('ES_VERSION_KEEP_FOR')) if os.getenv('ES_VERSION_KEEP_FOR') else None
+VERSION_THIN_INTERVAL = float(os.getenv('ES_VERSION_THIN_INTERVAL')) if os.getenv('ES_VERSION_THIN_INTERVAL') else None
+# Number of entities per batch of the compaction of the versions, and seconds between two background compactions
+COMPACTION_BATCH_SIZE = int(os.getenv('ES_COMPACTION_BATCH_SIZE', 500))
+COMPACTION_INTERVAL = float(os.getenv('ES_COMPACTION_INTERVAL', 3600))
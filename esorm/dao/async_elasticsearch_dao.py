@@ -0,0 +1,360 @@
+import asyncio
+import collections
+import threading
+from urllib.parse import quote, urlencode
+
+from elasticsearch.exceptions import HTTP_EXCEPTIONS, TransportError, ConnectionError, ConnectionTimeout
+
+from esorm.config import elasticsearch_config
+from esorm.dao.elasticsearch_dao import get_refresh_param, get_type_mapping, get_missing_mapping_keys, \
+    get_missing_templates, get_versioning_mapping_args, is_existing_index, set_mapping_ensured, chunk_actions, \
+    get_chunk_body, get_backoff, is_retried, set_chunk_items, get_bulk_options, get_template
+from esorm.util import serialization_util
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+def _escape(value):
+    """
+    Query string value of a request parameter, as sent by the elasticsearch client
+    """
+    if isinstance(value, (list, tuple)):
+        return ','.join(_escape(item) for item in value)
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def _make_path(*parts):
+    return '/' + '/'.join(quote(str(part), safe=',*') for part in parts if part is not None)
+
+
+class AsyncIndicesClient(object):
+    """
+    Indices API of AsyncElasticsearch
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    async def create(self, index, body=None, **params):
+        return await self.client.perform_request('PUT', _make_path(index), params, body)
+
+    async def put_mapping(self, doc_type, body, index=None, **params):
+        return await self.client.perform_request('PUT', _make_path(index, '_mapping', doc_type), params, body)
+
+    async def put_template(self, name, body, **params):
+        return await self.client.perform_request('PUT', _make_path('_template', name), params, body)
+
+    async def refresh(self, index=None, **params):
+        return await self.client.perform_request('POST', _make_path(index, '_refresh'), params)
+
+
+class AsyncElasticsearch(object):
+    """
+    Non-blocking elasticsearch client on aiohttp, with the methods of the elasticsearch client used by the ORM.
+    An HTTP session (and its connection pool) is created on first use in each event loop running the client
+    """
+
+    def __init__(self, host, port, timeout=None, maxsize=None, keep_alive=None):
+        if aiohttp is None:
+            raise ImportError('aiohttp is required by the asyncio API, install it with "pip install aiohttp"')
+        self.base_url = 'http://{esHost}:{esPort}'.format(esHost=host, esPort=port)
+        self.timeout = elasticsearch_config.TIMEOUT if timeout is None else timeout
+        self.maxsize = elasticsearch_config.MAXSIZE if maxsize is None else maxsize
+        self.keep_alive = elasticsearch_config.KEEP_ALIVE if keep_alive is None else keep_alive
+        self.serializer = serialization_util.get_serializer()
+        self.indices = AsyncIndicesClient(self)
+        # HTTP sessions keyed by event loop, a session can only be used in the event loop it was created in
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+
+    async def _get_session(self):
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            with self._sessions_lock:
+                closed_loops = [session_loop for session_loop in self._sessions if session_loop.is_closed()]
+                closed_sessions = [self._sessions.pop(session_loop) for session_loop in closed_loops]
+                connector = aiohttp.TCPConnector(limit_per_host=self.maxsize, force_close=not self.keep_alive)
+                session = self._sessions[loop] = aiohttp.ClientSession(
+                    connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+            # The connections of a closed event loop are only released, nothing is awaited in it
+            for closed_session in closed_sessions:
+                await closed_session.close()
+        return session
+
+    async def perform_request(self, method, path, params=None, body=None):
+        """
+        Sends a request, raising the exceptions of the elasticsearch client on errors
+        :param params: query string parameters, "ignore" being the status codes not raising an exception
+        :param body: JSON body, or serialized body as str or bytes
+        :return: deserialized response
+        """
+        params = dict(params or {})
+        ignore = params.pop('ignore', ())
+        if isinstance(ignore, int):
+            ignore = (ignore,)
+        url = self.base_url + path
+        if params:
+            url = '{}?{}'.format(url, urlencode({k: _escape(v) for k, v in params.items()}))
+        data = self.serializer.dumps_bytes(body) if body is not None else None
+        headers = {'Content-Type': 'application/json'} if data is not None else None
+
+        try:
+            session = await self._get_session()
+            async with session.request(method, url, data=data, headers=headers) as response:
+                status = response.status
+                raw_data = await response.read()
+        except asyncio.TimeoutError as e:
+            raise ConnectionTimeout('TIMEOUT', str(e), e)
+        except aiohttp.ClientError as e:
+            raise ConnectionError('N/A', str(e), e)
+
+        try:
+            data = self.serializer.loads(raw_data) if raw_data else {}
+        except TransportError:
+            data = raw_data.decode('utf-8', 'replace')
+        if not 200 <= status < 300 and status not in ignore:
+            error = data
+            if isinstance(data, dict):
+                error = data.get('error', data)
+                if isinstance(error, dict):
+                    error = error.get('type', error)
+            raise HTTP_EXCEPTIONS.get(status, TransportError)(status, error, data)
+        if isinstance(data, dict) and not 200 <= status < 300:
+            data.setdefault('status', status)
+        return data
+
+    async def index(self, index, doc_type, body, id=None, **params):
+        return await self.perform_request('POST' if id is None else 'PUT', _make_path(index, doc_type, id),
+                                          params, body)
+
+    async def get(self, index, id, doc_type='_all', **params):
+        return await self.perform_request('GET', _make_path(index, doc_type, id), params)
+
+    async def mget(self, body, index=None, doc_type=None, **params):
+        return await self.perform_request('POST', _make_path(index, doc_type, '_mget'), params, body)
+
+    async def search(self, index=None, doc_type=None, body=None, **params):
+        if 'from_' in params:
+            params['from'] = params.pop('from_')
+        return await self.perform_request('POST', _make_path(index, doc_type, '_search'), params, body)
+
+    async def count(self, index=None, doc_type=None, body=None, **params):
+        return await self.perform_request('POST', _make_path(index, doc_type, '_count'), params, body)
+
+    async def update(self, index, doc_type, id, body=None, **params):
+        return await self.perform_request('POST', _make_path(index, doc_type, id, '_update'), params, body)
+
+    async def bulk(self, body, index=None, doc_type=None, **params):
+        return await self.perform_request('POST', _make_path(index, doc_type, '_bulk'), params, body)
+
+    async def delete_by_query(self, index, body, doc_type=None, **params):
+        return await self.perform_request('POST', _make_path(index, doc_type, '_delete_by_query'), params, body)
+
+    async def update_by_query(self, index, doc_type=None, body=None, **params):
+        return await self.perform_request('POST', _make_path(index, doc_type, '_update_by_query'), params, body)
+
+    async def close(self):
+        """
+        Closes the HTTP sessions of all the event loops, the sessions of the event loops
+        not running are closed when their loop runs again
+        """
+        loop = asyncio.get_running_loop()
+        with self._sessions_lock:
+            sessions = self._sessions
+            self._sessions = {}
+        for session_loop, session in sessions.items():
+            if session.closed:
+                continue
+            if session_loop is loop or session_loop.is_closed():
+                await session.close()
+            else:
+                future = asyncio.run_coroutine_threadsafe(session.close(), session_loop)
+                if session_loop.is_running():
+                    await asyncio.wrap_future(future)
+
+
+# Asyncio clients shared by the process, keyed by (host, port, options)
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(host, port, **options):
+    """
+    Returns the asyncio client shared by the process for the host, port and options
+    :param options: overrides of the configured client options (timeout, maxsize, keep_alive)
+    :return: AsyncElasticsearch
+    """
+    key = (host, str(port), tuple(sorted(options.items())))
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = AsyncElasticsearch(host, port, **options)
+    return client
+
+
+async def close_clients():
+    """
+    Closes the HTTP sessions of the shared clients, e.g. when the event loop shuts down
+    """
+    for client in list(_clients.values()):
+        await client.close()
+
+
+class AsyncElasticsearchDao(object):
+    """
+    Asyncio Elasticsearch Data Access Object, see ElasticsearchDao
+    """
+
+    def __init__(self, host, port, **options):
+        self.connection = get_client(host, port, **options)
+        self.serializer = serialization_util.get_serializer()
+
+    def get_connection(self):
+        """
+        Returns the connection object
+        """
+        return self.connection
+
+    async def insert_one(self, doc, index, type, id, upsert=True, create_mapping=True, refresh=None, **params):
+        """
+        Insertion of a single elasticsearch document, see ElasticsearchDao.insert_one
+        """
+        refresh_param = get_refresh_param(refresh)
+        if create_mapping:
+            await self.ensure_mapping(index, type)
+
+        if not upsert:
+            return await self.connection.index(index, type, doc, refresh=refresh_param, **params)
+        return await self.connection.index(index, type, doc, id, refresh=refresh_param, **params)
+
+    async def update_one(self, body, index, type, id, refresh=None, **params):
+        """
+        Partial update of a single elasticsearch document, see ElasticsearchDao.update_one
+        """
+        return await self.connection.update(index, type, id, body, refresh=get_refresh_param(refresh), **params)
+
+    async def _send_chunk(self, chunk, max_retries, initial_backoff, max_backoff, **params):
+        """
+        Sends a chunk through the _bulk endpoint, retrying the actions rejected with 429 with exponential backoff
+        :return: <list> of response items, in the order of the chunk
+        """
+        items = [None] * len(chunk)
+        pending = list(range(len(chunk)))
+        for attempt in range(max_retries + 1):
+            if attempt > 0:
+                await asyncio.sleep(get_backoff(attempt, initial_backoff, max_backoff))
+
+            try:
+                res = await self.connection.bulk(get_chunk_body(chunk, pending), **params)
+            except TransportError as e:
+                if not is_retried(e, attempt, max_retries):
+                    raise
+                continue
+
+            pending = set_chunk_items(items, pending, res)
+            if not pending:
+                break
+        return items
+
+    async def bulk_iter(self, actions, chunk_size=None, max_chunk_bytes=None, max_in_flight=None, max_retries=None,
+                        initial_backoff=None, max_backoff=None, refresh=None):
+        """
+        Sends actions through the _bulk endpoint in chunks, see ElasticsearchDao.bulk_iter.
+        Up to max_in_flight chunks are sent concurrently, defaulting to the configured thread count
+        :return: async generator of per action response items, in the order of the actions
+        """
+        options = get_bulk_options(chunk_size, max_chunk_bytes, None, max_in_flight, max_retries,
+                                   initial_backoff, max_backoff)
+        params = {'max_retries': options['max_retries'],
+                  'initial_backoff': options['initial_backoff'],
+                  'max_backoff': options['max_backoff'],
+                  'refresh': get_refresh_param(refresh)}
+
+        in_flight = collections.deque()
+        try:
+            for chunk in chunk_actions(actions, options['chunk_size'], options['max_chunk_bytes'], self.serializer):
+                if len(in_flight) >= options['max_in_flight']:
+                    for item in await in_flight.popleft():
+                        yield item
+                in_flight.append(asyncio.ensure_future(self._send_chunk(chunk, **params)))
+            while in_flight:
+                for item in await in_flight.popleft():
+                    yield item
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+    async def bulk(self, actions, chunk_size=None, max_chunk_bytes=None, refresh=None, **kwargs):
+        """
+        Sends actions through the _bulk endpoint in chunks, see bulk_iter
+        :return: <list> of per action response items, in the order of the actions
+        """
+        return [item async for item in self.bulk_iter(actions, chunk_size, max_chunk_bytes, refresh=refresh,
+                                                      **kwargs)]
+
+    async def get_many(self, ids, index, type, **params):
+        """
+        Fetches documents by id with a single _mget request
+        :return: <list> of _mget docs, in the order of the ids
+        """
+        if not ids:
+            return []
+        res = await self.connection.mget({'ids': list(ids)}, index=index, doc_type=type, **params)
+        return res.get('docs', [])
+
+    async def create_mapping(self, index, type, data_mapping=None):
+        """
+        Creates the index with the mapping of the "_meta" and "data" fields, see ElasticsearchDao.create_mapping
+        """
+        type_mapping = get_type_mapping(data_mapping)
+        res = await self.connection.indices.create(index, {"mappings": {type: type_mapping}}, ignore=400)
+        if is_existing_index(res, data_mapping):
+            res = await self.connection.indices.put_mapping(type, type_mapping, index=index)
+        return res
+
+    async def ensure_mapping(self, index, type, data_mapping=None):
+        """
+        Creates the mapping once per process, shared with ElasticsearchDao.ensure_mapping
+        :return: True if the mapping was created or extended by this call
+        """
+        keys = get_missing_mapping_keys(index, type, data_mapping, self.serializer)
+        if not keys:
+            return False
+        await self.create_mapping(index, type, data_mapping)
+        set_mapping_ensured(*keys)
+        return True
+
+    async def create_template(self, index, type, data_mapping=None, alias=None):
+        """
+        Creates the index template of the partitions of an index, see ElasticsearchDao.create_template
+        """
+        name, body = get_template(index, type, data_mapping, alias, self.serializer)
+        res = await self.connection.indices.put_template(name, body)
+        if data_mapping is not None and alias is not None:
+            await self.connection.indices.put_mapping(type, get_type_mapping(data_mapping), index=alias, ignore=404)
+        return res
+
+    async def ensure_template(self, index, type, data_mapping=None, alias=None):
+        """
+        Creates the index templates of the partitions once per process, see ElasticsearchDao.ensure_template
+        """
+        template_mappings, keys = get_missing_templates(index, type, data_mapping, self.serializer)
+        for template_mapping in template_mappings:
+            await self.create_template(index, type, template_mapping, alias)
+        set_mapping_ensured(*keys)
+        return bool(template_mappings)
+
+    async def ensure_versioning_mapping(self, data_mapping=None):
+        """
+        Creates the mapping of the version index or its partitions, see ElasticsearchDao.ensure_versioning_mapping
+        """
+        partitioned, args = get_versioning_mapping_args(data_mapping)
+        return await self.ensure_template(*args) if partitioned else await self.ensure_mapping(*args)
@@ -1,5 +1,348 @@
+import collections
 import elasticsearch
-import json
+import functools
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from esorm.config import elasticsearch_config
+from esorm.util import serialization_util
+
+# Maps the ORM refresh policies to the values of the elasticsearch "refresh" parameter
+REFRESH_POLICIES = {
+    'none': 'false',
+    'wait_for': 'wait_for',
+    'immediate': 'true'
+}
+
+
+def get_refresh_param(refresh=None):
+    """
+    Resolves a refresh policy into the elasticsearch "refresh" parameter
+    :param refresh: one of "none", "wait_for" or "immediate", defaults to the configured policy
+    :return: value of the "refresh" parameter
+    """
+    if refresh is None:
+        refresh = elasticsearch_config.REFRESH_POLICY
+    if refresh not in REFRESH_POLICIES:
+        raise ValueError('Invalid refresh policy "{}", expected one of {}'.format(refresh,
+                                                                                 sorted(REFRESH_POLICIES.keys())))
+    return REFRESH_POLICIES[refresh]
+
+
+# Date formats of the names of the version index partitions
+PARTITION_FORMATS = {
+    'year': '%Y',
+    'month': '%Y.%m',
+    'day': '%Y.%m.%d'
+}
+
+
+def get_partition_format():
+    """
+    :return: date format of the version index partitions, None when the versions are not partitioned
+    """
+    partition = elasticsearch_config.VERSIONING_PARTITION
+    if partition == 'none':
+        return None
+    if partition not in PARTITION_FORMATS:
+        raise ValueError('Invalid versioning partition "{}", expected one of {}'.format(
+            partition, ['none'] + sorted(PARTITION_FORMATS.keys())))
+    return PARTITION_FORMATS[partition]
+
+
+def get_versioning_index(timestamp=None):
+    """
+    Index the versions modified at "timestamp" are written into, the partition of its period (UTC)
+    when the versions are partitioned
+    :param timestamp: epoch seconds, defaults to the current time
+    """
+    partition_format = get_partition_format()
+    if partition_format is None:
+        return elasticsearch_config.VERSIONING_INDEX
+    if timestamp is None:
+        timestamp = time.time()
+    partition = time.strftime(partition_format, time.gmtime(timestamp))
+    return '{}-{}'.format(elasticsearch_config.VERSIONING_INDEX, partition)
+
+
+def get_versioning_read_index():
+    """
+    Index or alias the versions are read from, the alias of all the partitions when the versions are partitioned
+    """
+    if get_partition_format() is None:
+        return elasticsearch_config.VERSIONING_INDEX
+    return elasticsearch_config.VERSIONING_ALIAS
+
+
+# Mapping of the "_meta" field written by the ORM
+META_MAPPING = {
+    "properties": {
+        "_class": {"type": "keyword"},
+        "_deleted": {"type": "boolean"},
+        "_last_modified": {"type": "date", "format": "epoch_second"},
+        "_version": {"type": "long"},
+        "_hash": {"type": "keyword", "index": False, "doc_values": False}
+    }
+}
+
+# Mapping of the "data" field when the entity class is not known, "uid" being sorted on by search_after
+DEFAULT_DATA_MAPPING = {
+    "properties": {
+        "uid": {"type": "keyword"},
+        "coordinates": {"type": "geo_point"}
+    }
+}
+
+# Mappings already created or extended by the process, keyed by (index, type), (index, type, data mapping)
+# and by the entity classes whose mappings were all ensured
+_ensured_mappings = set()
+_ensured_mappings_lock = threading.Lock()
+
+
+def clear_ensured_mappings():
+    """
+    Forgets the mappings ensured by the process, e.g. after deleting indices
+    """
+    with _ensured_mappings_lock:
+        _ensured_mappings.clear()
+
+
+def get_type_mapping(data_mapping=None):
+    """
+    Mapping of an index type, with the "_meta" and "data" fields
+    :param data_mapping: mapping of the "data" field, see StructuredEntity.get_mapping
+    """
+    return {
+        "properties": {
+            "_meta": META_MAPPING,
+            "data": DEFAULT_DATA_MAPPING if data_mapping is None else data_mapping
+        }
+    }
+
+
+def get_mapping_keys(index, type, data_mapping, serializer):
+    """
+    :return: (key of any mapping of the index type, key of the data mapping), see ensure_mapping
+    """
+    index_key = (index, type)
+    mapping_key = index_key if data_mapping is None else (index, type, serializer.dumps(data_mapping, sort_keys=True))
+    return index_key, mapping_key
+
+
+def get_template(index, type, data_mapping, alias, serializer):
+    """
+    Index template of the "index-*" partitions of an index. Each data mapping gets its own template,
+    elasticsearch merging all the templates matching a new partition
+    :param alias: alias added to the partitions, set on the template without data mapping
+    :return: (template name, template body)
+    """
+    if data_mapping is None:
+        name = '{}-base'.format(index)
+    else:
+        digest = hashlib.sha1(serializer.dumps_bytes(data_mapping, sort_keys=True)).hexdigest()
+        name = '{}-{}'.format(index, digest[:16])
+    body = {
+        "template": '{}-*'.format(index),
+        "order": 0 if data_mapping is None else 1,
+        "mappings": {type: get_type_mapping(data_mapping)}
+    }
+    if alias is not None and data_mapping is None:
+        body['aliases'] = {alias: {}}
+    return name, body
+
+
+def get_missing_mapping_keys(index, type, data_mapping, serializer):
+    """
+    :return: keys to set with set_mapping_ensured once the mapping is created, empty if it was already ensured
+    """
+    index_key, mapping_key = get_mapping_keys(index, type, data_mapping, serializer)
+    if is_mapping_ensured(mapping_key):
+        return ()
+    return index_key, mapping_key
+
+
+def get_missing_templates(index, type, data_mapping, serializer):
+    """
+    Templates of the partitions of an index to create before writing into them, see get_template
+    :return: (<list> of the data mappings of the templates to create, in order, keys to set with set_mapping_ensured
+    once created), empty if the templates were already ensured
+    """
+    keys = get_missing_mapping_keys('{}-*'.format(index), type, data_mapping, serializer)
+    if not keys:
+        return [], ()
+    # The template without data mapping, adding the alias, is created before the first data mapping
+    if data_mapping is not None and not is_mapping_ensured(keys[0]):
+        return [None, data_mapping], keys
+    return [data_mapping], keys
+
+
+def get_versioning_mapping_args(data_mapping=None):
+    """
+    :return: (True if the versions are partitioned, arguments of ensure_template if so, of ensure_mapping otherwise)
+    """
+    if get_partition_format() is None:
+        return False, (elasticsearch_config.VERSIONING_INDEX, elasticsearch_config.VERSIONING_TYPE, data_mapping)
+    return True, (elasticsearch_config.VERSIONING_INDEX, elasticsearch_config.VERSIONING_TYPE, data_mapping,
+                  elasticsearch_config.VERSIONING_ALIAS)
+
+
+def is_existing_index(res, data_mapping):
+    """
+    :param res: response of the creation of an index, see create_mapping
+    :return: True if the index already exists and its type mapping has to be extended with data_mapping
+    """
+    return res.get('status') == 400 and data_mapping is not None
+
+
+def is_mapping_ensured(key):
+    """
+    :param key: mapping key, see get_mapping_keys, or entity class
+    :return: True if the mapping was already created or extended by the process
+    """
+    return key in _ensured_mappings
+
+
+def set_mapping_ensured(*keys):
+    with _ensured_mappings_lock:
+        _ensured_mappings.update(keys)
+
+
+def chunk_actions(actions, chunk_size, max_chunk_bytes, serializer):
+    """
+    Serializes (action, source) pairs into _bulk chunks bounded by number of actions and bytes
+    :return: generator of chunks, a chunk being a <list> of the serialized lines of each action
+    """
+    dumps_bytes = serializer.dumps_bytes
+    chunk = []
+    size = 0
+    for action, source in actions:
+        action_lines = [dumps_bytes(action)]
+        if source is not None:
+            action_lines.append(dumps_bytes(source))
+        action_size = sum(len(line) + 1 for line in action_lines)
+
+        if chunk and (len(chunk) == chunk_size or size + action_size > max_chunk_bytes):
+            yield chunk
+            chunk = []
+            size = 0
+
+        chunk.append(action_lines)
+        size += action_size
+    if chunk:
+        yield chunk
+
+
+def get_chunk_body(chunk, positions):
+    """
+    :param positions: positions in the chunk of the actions to send
+    :return: _bulk body <bytes>, ending with a newline
+    """
+    return b'\n'.join(line for position in positions for line in chunk[position]) + b'\n'
+
+
+def get_backoff(attempt, initial_backoff, max_backoff):
+    """
+    :return: seconds to wait before sending a chunk again, doubled on every retry
+    """
+    return min(max_backoff, initial_backoff * 2 ** (attempt - 1))
+
+
+def is_retried(error, attempt, max_retries):
+    """
+    :return: True if a _bulk request failing with the TransportError is sent again
+    """
+    return error.status_code == 429 and attempt < max_retries
+
+
+def set_chunk_items(items, positions, res):
+    """
+    Sets the response items of the actions sent, see get_chunk_body
+    :param items: <list> of the response items of the chunk
+    :return: <list> of the positions of the actions rejected with 429, to send again
+    """
+    rejected = []
+    for position, item in zip(positions, res.get('items', [])):
+        items[position] = item
+        if next(iter(item.values())).get('status') == 429:
+            rejected.append(position)
+    return rejected
+
+
+def get_bulk_options(chunk_size=None, max_chunk_bytes=None, thread_count=None, max_in_flight=None,
+                     max_retries=None, initial_backoff=None, max_backoff=None):
+    """
+    Bulk options, defaulting to the configured values
+    :return: <dict> of the options
+    """
+    if thread_count is None:
+        thread_count = elasticsearch_config.BULK_THREAD_COUNT
+    return {
+        'chunk_size': elasticsearch_config.BULK_CHUNK_SIZE if chunk_size is None else chunk_size,
+        'max_chunk_bytes': elasticsearch_config.BULK_MAX_CHUNK_BYTES if max_chunk_bytes is None else max_chunk_bytes,
+        'thread_count': thread_count,
+        'max_in_flight': thread_count if max_in_flight is None else max_in_flight,
+        'max_retries': elasticsearch_config.BULK_MAX_RETRIES if max_retries is None else max_retries,
+        'initial_backoff': elasticsearch_config.BULK_INITIAL_BACKOFF if initial_backoff is None else initial_backoff,
+        'max_backoff': elasticsearch_config.BULK_MAX_BACKOFF if max_backoff is None else max_backoff
+    }
+
+
+# Elasticsearch clients shared by the process, keyed by (host, port, options)
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _default_client_options():
+    return {
+        'timeout': elasticsearch_config.TIMEOUT,
+        'maxsize': elasticsearch_config.MAXSIZE,
+        'keep_alive': elasticsearch_config.KEEP_ALIVE,
+        'sniff_on_start': elasticsearch_config.SNIFF_ON_START,
+        'sniff_on_connection_fail': elasticsearch_config.SNIFF_ON_CONNECTION_FAIL,
+        'sniffer_timeout': elasticsearch_config.SNIFFER_TIMEOUT
+    }
+
+
+def _create_client(host, port, options):
+    options = options.copy()
+    if not options.pop('keep_alive'):
+        options['headers'] = {'Connection': 'close'}
+    return elasticsearch.Elasticsearch(['http://{esHost}:{esPort}'.format(esHost=host, esPort=port)],
+                                       serializer=serialization_util.get_serializer(), **options)
+
+
+def get_client(host, port, **options):
+    """
+    Returns the elasticsearch client shared by the process for the host, port and options.
+    The client (and its connection pool) is created on first use
+    :param options: overrides of the configured client options (timeout, maxsize, keep_alive, sniff_on_start,
+    sniff_on_connection_fail, sniffer_timeout)
+    :return: elasticsearch client
+    """
+    client_options = _default_client_options()
+    client_options.update(options)
+    key = (host, str(port), tuple(sorted(client_options.items())))
+
+    client = _clients.get(key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _create_client(host, port, client_options)
+                _clients[key] = client
+    return client
+
+
+def close_clients():
+    """
+    Closes and forgets all the shared clients, e.g. after forking a worker process
+    """
+    with _clients_lock:
+        for client in _clients.values():
+            client.transport.close()
+        _clients.clear()
 
 
 class ElasticsearchDao(object):
@@ -7,9 +350,9 @@ class ElasticsearchDao(object):
     Elasticsearch Data Access Object for connection and insertion
     """
 
-    def __init__(self, host, port):
-        self.connection = elasticsearch.Elasticsearch(['http://{esHost}:{esPort}'.format(esHost=host, esPort=port)],
-                                                      timeout=3000)
+    def __init__(self, host, port, **options):
+        self.connection = get_client(host, port, **options)
+        self.serializer = serialization_util.get_serializer()
 
     def get_connection(self):
         """
@@ -17,77 +360,210 @@ class ElasticsearchDao(object):
         """
         return self.connection
 
-    def _bulk_insert(self, index, type, actionList):
-        try:
-            self.connection.index(index=index)
-        except:
-            pass
-        res = self.connection.bulk(body=actionList, index=index, doc_type=type)
-        self.connection.indices.refresh()
-        return res
-
-    def insert_bulk(self, doc_list, index, type, upsert=True, create_mapping=True):
+    def insert_bulk(self, doc_list, index, type, upsert=True, create_mapping=True, refresh_at_end=False, **kwargs):
         """
-        Insertion of elasticsearch documents
-        :param doc_list: list of JSON documents to be inserted
+        Insertion of elasticsearch documents, streamed in chunks bounded by number of documents and bytes.
+        The chunks are sent without refresh, whatever the configured refresh policy
+        :param doc_list: iterable of JSON documents to be inserted, consumed lazily
         :param index: name of the elasticsearch index
         :param type: name of the elasticsearch index type
+        :param refresh_at_end: refreshes the index once, after all the documents are inserted
+        :param kwargs: bulk options (chunk_size, max_chunk_bytes, thread_count, max_in_flight, max_retries,
+        initial_backoff, max_backoff), see bulk_iter
+        :return: (number of inserted documents, <list> of failed response items)
         """
-        actionList = []
-        actionCount = 1
-
         # Create mappings
         if create_mapping:
-            self.create_mapping(index, type)
-
-        for doc in doc_list:
-            item = doc.copy()
-            id = item.get('data', {}).get('uid')
-
-            if actionCount % 1000 == 0:
-                self._bulk_insert(index, type, actionList[:])
-                actionList = []
-
-            if upsert:
-                actionList.append({"index": {
-                    "_index": index,
-                    "_type": type,
-                    "_id": id
-                }})
+            self.ensure_mapping(index, type)
+
+        def actions():
+            for doc in doc_list:
+                if upsert:
+                    action = {"index": {"_index": index, "_type": type, "_id": doc.get('data', {}).get('uid')}}
+                else:
+                    action = {"index": {"_index": index, "_type": type}}
+                yield action, doc
+
+        inserted_count = 0
+        errors = []
+        for item in self.bulk_iter(actions(), refresh='none', **kwargs):
+            if 'error' in item.get('index', {}):
+                errors.append(item)
             else:
-                actionList.append({"index": {
-                    "_index": index,
-                    "_type": type
-                }})
-            actionList.append(item)
-            actionCount += 1
-        if len(actionList) > 0:
-            self._bulk_insert(index, type, actionList[:])
-
-    def insert_one(self, doc, index, type, id, upsert=True, create_mapping=True):
+                inserted_count += 1
+
+        if refresh_at_end:
+            self.connection.indices.refresh(index=index)
+        return inserted_count, errors
+
+    def insert_one(self, doc, index, type, id, upsert=True, create_mapping=True, refresh=None, **params):
+        """
+        Insertion of a single elasticsearch document
+        :param refresh: refresh policy ("none", "wait_for" or "immediate"), defaults to the configured policy
+        :param params: index parameters, e.g. op_type="create" or version for conditional writes
+        """
+        refresh_param = get_refresh_param(refresh)
+
         # Create mappings
         if create_mapping:
-            self.create_mapping(index, type)
+            self.ensure_mapping(index, type)
 
         if not upsert:
-            res = self.connection.index(index, type, doc)
+            res = self.connection.index(index, type, doc, refresh=refresh_param, **params)
         else:
-            res = self.connection.index(index, type, doc, id)
+            res = self.connection.index(index, type, doc, id, refresh=refresh_param, **params)
         return res
 
-    def create_mapping(self, index, type):
-        mapping = {
-            "mappings": {
-                type: {
-                    "properties": {
-                        "data": {
-                            "properties": {
-                                "coordinates": {"type": "geo_point"}
-                            }
-                        }
-
-                    }
-                }
-            }
-        }
-        return self.connection.indices.create(index=index, ignore=400, body=json.dumps(mapping))
+    def update_one(self, body, index, type, id, refresh=None, **params):
+        """
+        Partial update of a single elasticsearch document
+        :param body: update body, with a partial "doc" or a "script"
+        :param refresh: refresh policy ("none", "wait_for" or "immediate"), defaults to the configured policy
+        :param params: update parameters, e.g. version for conditional updates
+        """
+        return self.connection.update(index, type, id, body, refresh=get_refresh_param(refresh), **params)
+
+    def _send_chunk(self, chunk, max_retries, initial_backoff, max_backoff, **params):
+        """
+        Sends a chunk through the _bulk endpoint, retrying the actions rejected with 429 with exponential backoff
+        :return: <list> of response items, in the order of the chunk
+        """
+        items = [None] * len(chunk)
+        pending = list(range(len(chunk)))
+        for attempt in range(max_retries + 1):
+            if attempt > 0:
+                time.sleep(get_backoff(attempt, initial_backoff, max_backoff))
+
+            # The elasticsearch client only accepts a str or a list of actions as _bulk body
+            body = get_chunk_body(chunk, pending).decode('utf-8')
+            try:
+                res = self.connection.bulk(body, **params)
+            except elasticsearch.TransportError as e:
+                if not is_retried(e, attempt, max_retries):
+                    raise
+                continue
+
+            pending = set_chunk_items(items, pending, res)
+            if not pending:
+                break
+        return items
+
+    def bulk_iter(self, actions, chunk_size=None, max_chunk_bytes=None, thread_count=None, max_in_flight=None,
+                  max_retries=None, initial_backoff=None, max_backoff=None, refresh=None):
+        """
+        Sends actions through the _bulk endpoint in chunks, consuming the actions lazily so that only the
+        chunks in flight are held in memory
+        :param actions: iterable of (action, source) pairs, source is None for delete actions
+        :param chunk_size: maximum number of actions per request, defaults to the configured size
+        :param max_chunk_bytes: maximum size of a request body, defaults to the configured size
+        :param thread_count: number of threads sending chunks, defaults to the configured count
+        :param max_in_flight: maximum number of chunks sent or waiting to be sent, defaults to thread_count
+        :param max_retries: number of retries of the actions rejected with 429, defaults to the configured count
+        :param initial_backoff: seconds to wait before the first retry, doubled on every retry
+        :param max_backoff: maximum seconds to wait before a retry
+        :param refresh: refresh policy ("none", "wait_for" or "immediate"), defaults to the configured policy
+        :return: generator of per action response items, in the order of the actions
+        """
+        options = get_bulk_options(chunk_size, max_chunk_bytes, thread_count, max_in_flight, max_retries,
+                                   initial_backoff, max_backoff)
+        thread_count = options['thread_count']
+        max_in_flight = options['max_in_flight']
+        send_chunk = functools.partial(self._send_chunk,
+                                       max_retries=options['max_retries'],
+                                       initial_backoff=options['initial_backoff'],
+                                       max_backoff=options['max_backoff'],
+                                       refresh=get_refresh_param(refresh))
+
+        chunks = chunk_actions(actions, options['chunk_size'], options['max_chunk_bytes'], self.serializer)
+        if thread_count <= 1:
+            for chunk in chunks:
+                for item in send_chunk(chunk):
+                    yield item
+            return
+
+        with ThreadPoolExecutor(max_workers=thread_count) as executor:
+            in_flight = collections.deque()
+            for chunk in chunks:
+                if len(in_flight) >= max_in_flight:
+                    for item in in_flight.popleft().result():
+                        yield item
+                in_flight.append(executor.submit(send_chunk, chunk))
+            while in_flight:
+                for item in in_flight.popleft().result():
+                    yield item
+
+    def bulk(self, actions, chunk_size=None, max_chunk_bytes=None, refresh=None, **kwargs):
+        """
+        Sends actions through the _bulk endpoint in chunks, see bulk_iter
+        :return: <list> of per action response items, in the order of the actions
+        """
+        return list(self.bulk_iter(actions, chunk_size, max_chunk_bytes, refresh=refresh, **kwargs))
+
+    def get_many(self, ids, index, type, **params):
+        """
+        Fetches documents by id with a single _mget request
+        :param ids: list of document ids
+        :return: <list> of _mget docs, in the order of the ids
+        """
+        if not ids:
+            return []
+        res = self.connection.mget({'ids': list(ids)}, index=index, doc_type=type, **params)
+        return res.get('docs', [])
+
+    def create_mapping(self, index, type, data_mapping=None):
+        """
+        Creates the index with the mapping of the "_meta" and "data" fields.
+        When the index already exists, the mapping of the type is extended with data_mapping
+        :param data_mapping: mapping of the "data" field, see StructuredEntity.get_mapping
+        :return: create or put mapping response
+        """
+        type_mapping = get_type_mapping(data_mapping)
+        res = self.connection.indices.create(index=index, ignore=400, body={"mappings": {type: type_mapping}})
+        if is_existing_index(res, data_mapping):
+            res = self.connection.indices.put_mapping(doc_type=type, body=type_mapping, index=index)
+        return res
+
+    def ensure_mapping(self, index, type, data_mapping=None):
+        """
+        Creates the mapping once per process, see create_mapping.
+        Without data_mapping, nothing is sent when any mapping was already ensured for the index and type
+        :return: True if the mapping was created or extended by this call
+        """
+        keys = get_missing_mapping_keys(index, type, data_mapping, self.serializer)
+        if not keys:
+            return False
+        self.create_mapping(index, type, data_mapping)
+        set_mapping_ensured(*keys)
+        return True
+
+    def create_template(self, index, type, data_mapping=None, alias=None):
+        """
+        Creates the index template of the partitions of an index, see get_template.
+        The data mapping is also added to the partitions already created, through the alias
+        :return: put template response
+        """
+        name, body = get_template(index, type, data_mapping, alias, self.serializer)
+        res = self.connection.indices.put_template(name=name, body=body)
+        if data_mapping is not None and alias is not None:
+            self.connection.indices.put_mapping(doc_type=type, body=get_type_mapping(data_mapping), index=alias,
+                                                ignore=404)
+        return res
+
+    def ensure_template(self, index, type, data_mapping=None, alias=None):
+        """
+        Creates the index templates of the partitions once per process, see create_template
+        :return: True if a template was created by this call
+        """
+        template_mappings, keys = get_missing_templates(index, type, data_mapping, self.serializer)
+        for template_mapping in template_mappings:
+            self.create_template(index, type, template_mapping, alias)
+        set_mapping_ensured(*keys)
+        return bool(template_mappings)
+
+    def ensure_versioning_mapping(self, data_mapping=None):
+        """
+        Creates the mapping of the version index once per process,
+        or the index templates of its partitions when the versions are partitioned
+        """
+        partitioned, args = get_versioning_mapping_args(data_mapping)
+        return self.ensure_template(*args) if partitioned else self.ensure_mapping(*args)
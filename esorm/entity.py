@@ -1,27 +1,104 @@
+import asyncio
+import collections
+import inspect
+import itertools
+import types
 import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 from esorm.base import Base
 from esorm.exception import *
 from esorm import versioning
+from esorm import cache
+from esorm import retention
 from esorm.util import elasticsearch_query_builder_util
+from esorm.util import serialization_util
 from esorm.dao import elasticsearch_dao
+from esorm.dao import async_elasticsearch_dao
 from esorm.config import elasticsearch_config
 
 
-class StructuredEntity(Base):
+# Compiled field of an entity class, with the bound methods of its property
+Field = collections.namedtuple('Field', ['name', 'property', 'inflate_trusted', 'deflate',
+                                         'validate_value', 'validate_allowed_value', 'passthrough'])
+
+
+def get_trusted_inflate(field_property):
+    """
+    Inflate method of a property without its validation decorators, for values read from elasticsearch
+    which were validated when saved
+    """
+    inflate_trusted = getattr(field_property, 'inflate_trusted', None)
+    if inflate_trusted is not None:
+        return inflate_trusted
+    inflate = field_property.inflate
+    return types.MethodType(inspect.unwrap(inflate.__func__), field_property)
+
+
+def _compile_field(name, field_property):
+    return Field(name=name,
+                 property=field_property,
+                 inflate_trusted=get_trusted_inflate(field_property),
+                 deflate=field_property.deflate,
+                 validate_value=field_property.validate_value,
+                 validate_allowed_value=getattr(field_property, 'validate_allowed_value', None),
+                 passthrough=field_property.passthrough)
+
+
+def _get_stored_values(data):
+    """
+    Snapshot of the deflated "data" of a stored document, lists and objects being serialized so that
+    the values changed in place since are told apart when saving
+    :return: <dict> of the values by field name
+    """
+    dumps_bytes = serialization_util.get_serializer().dumps_bytes
+    return {key: dumps_bytes(value, sort_keys=True) if isinstance(value, (list, dict)) else value
+            for key, value in data.items()}
+
+
+class EntityMeta(type):
+    """
+    Metaclass of the entities, giving every entity class a __dict__-less, slot-based instance layout
+    """
+
+    def __new__(mcs, name, bases, namespace, **kwargs):
+        namespace.setdefault('__slots__', ())
+        return super().__new__(mcs, name, bases, namespace, **kwargs)
+
+
+class StructuredEntity(Base, metaclass=EntityMeta):
+    # "_field_name" is only set on the entities used as a field of another entity class
+    __slots__ = ('value_dict', '_version', '_hash', '_dirty_fields', '_stored_values', '_field_name')
     data_type = Base
+    # Entities used as properties are inflated from their JSON value
+    passthrough = False
+    # Field table of the class, compiled once when the class is defined
+    _fields = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._fields = collections.OrderedDict((name, _compile_field(name, value))
+                                              for name, value in vars(cls).items() if isinstance(value, Base))
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
-        argument_list = [k for k, v in kwargs.items()]
-        class_property_list = [k for k, v in vars(self.__class__).items() if isinstance(v, Base)]
-        extra_args = list(set(argument_list) - set(class_property_list))
-        for arg in extra_args:
-            raise InvalidArgumentError(arg, self.__class__)
+        fields = self._fields
+        for arg in kwargs:
+            if arg not in fields:
+                raise InvalidArgumentError(arg, self.__class__)
 
         self.value_dict = {}
 
+        # Elasticsearch version and content hash of the stored document, known once loaded or saved
+        self._version = None
+        self._hash = None
+        # Fields modified since loaded or saved
+        self._dirty_fields = set(kwargs.keys())
+        # Deflated values of the stored document, known once loaded or saved
+        self._stored_values = None
+
         for key, value in kwargs.items():
             # target_obj = self.__class__.__dict__[key]
             self.value_dict[key] = value
@@ -43,42 +120,137 @@ class StructuredEntity(Base):
             #     self.value_dict[key] = value.get_value_as_json()
         pass
 
+    @classmethod
+    def from_source(cls, data, version=None, hash=None):
+        """
+        Creates an entity from the "data" of a document read from elasticsearch, without validating it again.
+        Values set by the application have to go through the constructor or set_value
+        :param data: "data" of the document
+        :param version: elasticsearch version of the document
+        :param hash: content hash of the document
+        :return: entity
+        """
+        fields = cls._fields
+        value_dict = {}
+        for key, value in data.items():
+            field = fields[key]
+            # Values of fields needing no conversion are used as read
+            value_dict[key] = value if field.passthrough else field.inflate_trusted(value)
+
+        entity = cls.__new__(cls)
+        entity.value_dict = value_dict
+        entity._version = version
+        entity._hash = hash
+        entity._dirty_fields = set()
+        # Documents read from the entity index are diffed against when saved, nested entities have no version
+        entity._stored_values = None if version is None else _get_stored_values(data)
+        return entity
+
+    def __set_name__(self, owner, name):
+        self._field_name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance.value_dict.get(self._field_name)
+
+    def __set__(self, instance, value):
+        instance.set_value(self._field_name, value)
+
     def __str__(self):
         return '<class {}: {}'.format(self.__class__.__name__, repr(self.value_dict))
 
     def _validate_allowed_values(self, value=None, **kwargs):
         if value is None:
             value = {}
-        for k, v in value.items():
-            if 'validate_allowed_value' in dir(self.__class__.__dict__[k]):
-                if self.__class__.__dict__[k].validate_allowed_value(v):
-                    self.__dict__[k] = v
-                else:
-                    raise ValueError('Value "{}" not in allowed_values of attribute "{}"'.format(str(v), str(k)))
-
-        for k, v in kwargs.items():
-            if 'validate_allowed_value' in dir(self.__class__.__dict__[k]):
-                if self.__class__.__dict__[k].validate_allowed_value(v):
-                    self.__dict__[k] = v
-                else:
+        fields = self._fields
+        for k, v in itertools.chain(value.items(), kwargs.items()):
+            validate_allowed_value = fields[k].validate_allowed_value
+            if validate_allowed_value is not None:
+                if not validate_allowed_value(v):
                     raise ValueError('Value "{}" not in allowed_values of attribute "{}"'.format(str(v), str(k)))
 
     @classmethod
     def _deflate_all_properties(cls, properties):
         item = {}
+        fields = cls._fields
         for key, value in properties.items():
             if key.startswith('_'):
                 continue
-            item[key] = cls.__dict__[key].deflate(value)
+            item[key] = fields[key].deflate(value)
         return item
 
+    @classmethod
+    def get_mapping(cls):
+        """
+        Elasticsearch mapping of the entity, generated from the properties of the class
+        :return: "object" mapping <dict>
+        """
+        properties = {}
+        for key, field in cls._fields.items():
+            mapping = field.property.get_mapping()
+            if mapping is not None:
+                properties[key] = mapping
+        return {"type": "object", "properties": properties}
+
+    @classmethod
+    def create_mapping(cls):
+        """
+        Creates or extends the mappings of the entity and version indices with the properties of the class,
+        or the index templates of the version partitions when the versions are partitioned by time.
+        Requests are only sent the first time in the process, it can be called at startup to bootstrap the indices
+        """
+        # Once ensured, the class is looked up without generating and serializing its mapping on every save
+        if elasticsearch_dao.is_mapping_ensured(cls):
+            return
+        es_conn = elasticsearch_dao.ElasticsearchDao(elasticsearch_config.HOST, elasticsearch_config.PORT)
+        data_mapping = cls.get_mapping()
+        es_conn.ensure_mapping(elasticsearch_config.INDEX, elasticsearch_config.TYPE, data_mapping)
+        es_conn.ensure_versioning_mapping(data_mapping)
+        elasticsearch_dao.set_mapping_ensured(cls)
+
+    @classmethod
+    async def acreate_mapping(cls):
+        """
+        Creates or extends the mappings of the entity and version indices, see create_mapping
+        """
+        if elasticsearch_dao.is_mapping_ensured(cls):
+            return
+        es_conn = async_elasticsearch_dao.AsyncElasticsearchDao(elasticsearch_config.HOST, elasticsearch_config.PORT)
+        data_mapping = cls.get_mapping()
+        await es_conn.ensure_mapping(elasticsearch_config.INDEX, elasticsearch_config.TYPE, data_mapping)
+        await es_conn.ensure_versioning_mapping(data_mapping)
+        elasticsearch_dao.set_mapping_ensured(cls)
+
+    @classmethod
+    def set_retention_policy(cls, policy):
+        """
+        Sets the retention policy of the versions of the class, see retention.RetentionPolicy
+        :param policy: RetentionPolicy, None keeping all the versions
+        """
+        retention.set_retention_policy(cls, policy)
+
+    @classmethod
+    def compact_versions(cls, refresh=None):
+        """
+        Deletes the versions of the entities of the class expired by its retention policy
+        :param refresh: refresh policy ("none", "wait_for" or "immediate"), defaults to the configured policy
+        :return: <dict> of the number of compacted entities and deleted versions
+        """
+        return retention.VersionCompactor().compact([cls.__name__], refresh=refresh)
+
     @classmethod
     def entities(cls):
         return EntitySet(cls)
 
+    @classmethod
+    def async_entities(cls):
+        return AsyncEntitySet(cls)
+
     def deflate(self, value):
         if isinstance(value, StructuredEntity):
-            return value.get_value_as_json()
+            # Deflated by its own properties, for the stored values to match the mapping of the entity
+            return value._deflate_all_properties(value.value_dict)
         return value
 
     def inflate(self, value):
@@ -86,6 +258,17 @@ class StructuredEntity(Base):
             return self.__class__(**value)
         return value
 
+    def inflate_trusted(self, value):
+        return self.__class__.from_source(value)
+
+    def validate_value(self, value):
+        """
+        Validates the value of a field of this entity type
+        """
+        if not isinstance(value, self.__class__):
+            raise InvalidTypeError(value, self.__class__)
+        return value
+
     def get_value_as_json(self):
         json_item = {}
         for key, value in self.value_dict.items():
@@ -99,8 +282,8 @@ class StructuredEntity(Base):
 
     def set_value(self, item, value):
         self._validate_allowed_values(value={item: value})
-        self.__class__.__dict__[item].set_value(value)
-        self.value_dict[item] = self.__class__.__dict__[item].get_value()
+        self.value_dict[item] = self._fields[item].validate_value(value)
+        self._dirty_fields.add(item)
 
     def get_value(self, item):
         if isinstance(self.value_dict[item], list):
@@ -110,46 +293,270 @@ class StructuredEntity(Base):
         else:
             return self.value_dict[item]
 
-    def save(self):
-        """
-        Saves the Entity object into elasticsearch
-        """
+    def _get_document(self):
         meta_item = {
             '_class': self.__class__.__name__,
-            '_last_modified': time.time(),
+            # Whole seconds, elasticsearch 5 rejecting fractional epoch_second values such as 1496275200.123456
+            '_last_modified': int(time.time()),
             '_deleted': False
         }
         deflated_properties = self._deflate_all_properties(self.value_dict)
-        item = {'_meta': meta_item, 'data': deflated_properties}
-        is_saved, res = versioning.Version().insert(item)
-        # Adding sleep time to provide elasticsearch buffer time to index the insert document
-        time.sleep(2)
+        meta_item['_hash'] = versioning.get_hash(deflated_properties)
+        return {'_meta': meta_item, 'data': deflated_properties}
+
+    def _invalidate_cache(self, version=None, all_versions=False):
+        entity_cache = cache.get_cache()
+        if entity_cache is not None:
+            entity_cache.invalidate(self.__class__.__name__, self.value_dict.get('uid'), version, all_versions)
+
+    def _set_stored(self, version, hash, data=None):
+        self._version = version
+        self._hash = hash
+        self._dirty_fields = set()
+        self._stored_values = None if data is None else _get_stored_values(data)
+
+    def get_dirty_fields(self):
+        """
+        Fields modified with set_value since the entity was loaded or saved.
+        Values changed in place are not listed, they are still found and written by save
+        :return: <set> of field names
+        """
+        return set(self._dirty_fields)
+
+    def save(self, refresh=None):
+        """
+        Saves the Entity object into elasticsearch
+        :param refresh: refresh policy ("none", "wait_for" or "immediate"), defaults to the configured policy.
+        Use "wait_for" when the saved entity has to be visible to the next search.
+        An entity loaded from elasticsearch is only saved if it was not modified concurrently since,
+        VersionConflictError being raised otherwise, and only its modified fields are sent to the entity index.
+        The exception of the elasticsearch client is raised when the version of the document could not be written
+        """
+        document, fields = self._get_changed_document()
+        if document is None:
+            return False
+
+        self.create_mapping()
+        try:
+            if fields is not None:
+                is_saved, res = versioning.Version().update(document, fields,
+                                                            refresh=refresh, version=self._version)
+            else:
+                is_saved, res = versioning.Version().insert(document, refresh=refresh, version=self._version)
+        finally:
+            self._invalidate_cache()
+        if is_saved:
+            self._set_stored(document['_meta']['_version'], document['_meta']['_hash'], document['data'])
         return is_saved
 
-    def delete(self):
+    def _get_changed_document(self):
+        """
+        :return: (document to save, fields to write to the stored document or None to insert the document),
+        the document being None if the entity did not change since loaded or saved
+        """
+        document = self._get_document()
+        if self._version is None:
+            return document, None
+
+        if self._stored_values is not None:
+            fields = self._get_changed_fields(document['data'])
+        elif document['_meta']['_hash'] != self._hash:
+            fields = [key for key in document['data'] if key in self._dirty_fields]
+        else:
+            fields = []
+        if not fields:
+            self._dirty_fields = set()
+            return None, None
+        return document, fields
+
+    def _get_changed_fields(self, data):
+        """
+        Fields whose deflated value differs from the stored document, set_value being bypassed
+        by the values changed in place
+        :param data: deflated "data" of the document to save
+        :return: <list> of field names
+        """
+        stored_values = self._stored_values
+        dumps_bytes = serialization_util.get_serializer().dumps_bytes
+        fields = []
+        for key, value in data.items():
+            if key not in stored_values:
+                fields.append(key)
+                continue
+            stored_value = stored_values[key]
+            if isinstance(value, (list, dict)):
+                value = dumps_bytes(value, sort_keys=True)
+            # Types are compared too, 1 and 1.0 or True being stored differently
+            if type(value) is not type(stored_value) or value != stored_value:
+                fields.append(key)
+        return fields
+
+    async def asave(self, refresh=None):
+        """
+        Saves the Entity object into elasticsearch with non-blocking requests, see save
+        """
+        document, fields = self._get_changed_document()
+        if document is None:
+            return False
+
+        await self.acreate_mapping()
+        try:
+            if fields is not None:
+                is_saved, res = await versioning.AsyncVersion().update(document, fields,
+                                                                       refresh=refresh, version=self._version)
+            else:
+                is_saved, res = await versioning.AsyncVersion().insert(document, refresh=refresh,
+                                                                       version=self._version)
+        finally:
+            self._invalidate_cache()
+        if is_saved:
+            self._set_stored(document['_meta']['_version'], document['_meta']['_hash'], document['data'])
+        return is_saved
+
+    @classmethod
+    def save_many(cls, entities, refresh=None, chunk_size=None, max_chunk_bytes=None):
+        """
+        Saves many Entity objects into elasticsearch with batched _mget and _bulk requests
+        :param entities: iterable of Entity objects
+        :param refresh: refresh policy ("none", "wait_for" or "immediate"), defaults to the configured policy
+        :param chunk_size: maximum number of entities per batch, defaults to the configured size
+        :param max_chunk_bytes: maximum size of a _bulk request body, defaults to the configured size
+        :return: <list> of (is_saved, response) tuples, in the order of the entities
+        """
+        mapped_classes = set()
+        pending = collections.deque()
+
+        def documents():
+            for entity in entities:
+                if entity.__class__ not in mapped_classes:
+                    entity.create_mapping()
+                    mapped_classes.add(entity.__class__)
+                document = entity._get_document()
+                pending.append((entity, document))
+                yield document
+
+        results = []
+        for is_saved, res in versioning.Version().insert_many(documents(),
+                                                               refresh=refresh,
+                                                               chunk_size=chunk_size,
+                                                               max_chunk_bytes=max_chunk_bytes):
+            entity, document = pending.popleft()
+            entity._invalidate_cache()
+            if is_saved:
+                entity._set_stored(document['_meta']['_version'], document['_meta']['_hash'], document['data'])
+            results.append((is_saved, res))
+        return results
+
+    @classmethod
+    async def asave_many(cls, entities, refresh=None, chunk_size=None, max_chunk_bytes=None):
+        """
+        Saves many Entity objects into elasticsearch with non-blocking requests, see save_many
+        :return: <list> of (is_saved, response) tuples, in the order of the entities
+        """
+        entities = list(entities)
+        for entity_class in set(entity.__class__ for entity in entities):
+            await entity_class.acreate_mapping()
+        documents = [entity._get_document() for entity in entities]
+
+        results = []
+        position = 0
+        async for is_saved, res in versioning.AsyncVersion().insert_many(documents,
+                                                                          refresh=refresh,
+                                                                          chunk_size=chunk_size,
+                                                                          max_chunk_bytes=max_chunk_bytes):
+            entity, document = entities[position], documents[position]
+            position += 1
+            entity._invalidate_cache()
+            if is_saved:
+                entity._set_stored(document['_meta']['_version'], document['_meta']['_hash'], document['data'])
+            results.append((is_saved, res))
+        return results
+
+    def delete(self, refresh=None):
         """
         Deletes the entity
+        :param refresh: refresh policy ("none", "wait_for" or "immediate"), defaults to the configured policy
         :return:
         """
-        return versioning.Version().delete(self.get_value('uid'))
+        try:
+            return versioning.Version().delete(self.get_value('uid'), refresh=refresh)
+        finally:
+            self._invalidate_cache(all_versions=True)
 
+    async def adelete(self, refresh=None):
+        """
+        Deletes the entity with non-blocking requests, see delete
+        """
+        try:
+            return await versioning.AsyncVersion().delete(self.get_value('uid'), refresh=refresh)
+        finally:
+            self._invalidate_cache(all_versions=True)
 
-    def get_all_versions(self):
+    def get_all_versions(self, page_size=None):
         """
         Retrieve a list of all versions of an entity
-        :return: <list> of version numbers
+        :param page_size: number of versions fetched per request, defaults to the configured size
+        :return: <list> of version numbers, in ascending order
         """
-        return versioning.Version().get_all_versions(self.get_value('uid'))
+        return versioning.Version().get_all_versions(self.get_value('uid'), page_size)
+
+    async def aget_all_versions(self, page_size=None):
+        """
+        Retrieve a list of all versions of an entity with non-blocking requests, see get_all_versions
+        """
+        return await versioning.AsyncVersion().get_all_versions(self.get_value('uid'), page_size)
+
+    def version_count(self):
+        """
+        Number of versions of an entity, without fetching them
+        :return: <int>
+        """
+        return versioning.Version().version_count(self.get_value('uid'))
+
+    async def aversion_count(self):
+        """
+        Number of versions of an entity with a non-blocking request, see version_count
+        """
+        return await versioning.AsyncVersion().version_count(self.get_value('uid'))
+
+    def _get_cached_version(self, version):
+        entity_cache = cache.get_cache()
+        if entity_cache is None:
+            return None
+        return entity_cache.get(self.__class__.__name__, self.get_value('uid'), version)
+
+    def _set_loaded_version(self, version, doc, cached):
+        entity_cache = cache.get_cache()
+        # Version documents never change, they are cached until evicted
+        if entity_cache is not None and doc and not cached:
+            entity_cache.set(self.__class__.__name__, self.get_value('uid'), {'_source': doc.get('_source')}, version)
+        self.value_dict = self.entities()._inflate(doc.get('_source', {})).value_dict
+        stored_version = self._version
+        # Saving the loaded version overwrites the stored document, as long as it was not modified concurrently
+        self._set_stored(stored_version, None)
+        self._dirty_fields = set(self.value_dict.keys())
+        return self
 
     def load_version(self, version):
         """
         Load a version into an Entity object
         :param version: version number
         """
-        params = versioning. \
-            Version().get_doc_by_version(self.get_value('uid'), version).get('_source', {}).get('data', {})
-        self.__dict__ = self.__class__(**params).__dict__
-        return self
+        doc = self._get_cached_version(version)
+        cached = doc is not None
+        if not cached:
+            doc = versioning.Version().get_doc_by_version(self.get_value('uid'), version)
+        return self._set_loaded_version(version, doc, cached)
+
+    async def aload_version(self, version):
+        """
+        Load a version into an Entity object with a non-blocking request, see load_version
+        """
+        doc = self._get_cached_version(version)
+        cached = doc is not None
+        if not cached:
+            doc = await versioning.AsyncVersion().get_doc_by_version(self.get_value('uid'), version)
+        return self._set_loaded_version(version, doc, cached)
 
     def delete_version(self, version):
         """
@@ -157,7 +564,19 @@ class StructuredEntity(Base):
         :param version: version number
         :return: delete response
         """
-        return versioning.Version().delete_version(self.get_value('uid'), version)
+        try:
+            return versioning.Version().delete_version(self.get_value('uid'), version)
+        finally:
+            self._invalidate_cache(version)
+
+    async def adelete_version(self, version):
+        """
+        Delete a version of an entity with a non-blocking request, see delete_version
+        """
+        try:
+            return await versioning.AsyncVersion().delete_version(self.get_value('uid'), version)
+        finally:
+            self._invalidate_cache(version)
 
 
 class EntitySet(object):
@@ -169,20 +588,38 @@ class EntitySet(object):
         self.query_builder = elasticsearch_query_builder_util.QueryBuilder()
         self.cls = cls
 
-    def _inflate(self, doc):
-        inflated_params = {}
-        data_item = doc.get('data', {})
-        for param in data_item.keys():
-            inflated_property = self.cls.__dict__[param].inflate(data_item[param])
-            inflated_params[param] = inflated_property
-        instance = self.cls(**inflated_params)
-        return instance
+    def _inflate(self, doc, version=None):
+        # Documents of the index were validated when saved
+        return self.cls.from_source(doc.get('data', {}), version, doc.get('_meta', {}).get('_hash'))
 
-    def get(self, **kwargs):
+    def _get_property(self, field):
         """
-        Method to search elasticsearch for specified keyword arguments
-        :return: List of matching documents
+        Property of a field, "__" separating the fields of nested entities
+        :return: property, None if the field is not defined
         """
+        target_cls = self.cls
+        target_property = None
+        for name in field.split('__'):
+            if target_cls is None:
+                return None
+            field = target_cls._fields.get(name)
+            target_property = field.property if field is not None else None
+            if isinstance(target_property, StructuredEntity):
+                target_cls = target_property.__class__
+            elif isinstance(getattr(target_property, 'base_property', None), StructuredEntity):
+                target_cls = target_property.base_property.__class__
+            else:
+                target_cls = None
+        return target_property
+
+    def _is_full_text(self, key):
+        field = key.rsplit('__', 1)[0] if key.rsplit('__', 1)[-1] in self.query_builder.LOOKUPS else key
+        return getattr(self._get_property(field), 'full_text', False)
+
+    def _get_full_text_fields(self, keys):
+        return [key for key in keys if not key.startswith('_') and self._is_full_text(key)]
+
+    def _get_match_query(self, kwargs):
         params = kwargs.copy()
         params_json = {key: value.get_value_as_json() if isinstance(value, StructuredEntity)
         else value
@@ -195,11 +632,511 @@ class EntitySet(object):
         params_json['_deleted'] = False
 
         # TODO: Support search by Entity type
-        match_query = self.query_builder.must_match(params_json)
+        match_query = self.query_builder.filter_match(params_json, self._get_full_text_fields(params_json.keys()))
+        # Returning the version of the documents for optimistic concurrency on save
+        match_query['version'] = True
+        return match_query
+
+    def get(self, **kwargs):
+        """
+        Method to search elasticsearch for specified keyword arguments
+        :return: List of matching documents
+        """
+        entity_cache, doc_list = self._get_cached_lookup(kwargs)
+        if doc_list is not None:
+            return doc_list
+
+        match_query = self._get_match_query(kwargs)
         es_conn = elasticsearch_dao.ElasticsearchDao(elasticsearch_config.HOST, elasticsearch_config.PORT)
         search_res = es_conn.get_connection().search(elasticsearch_config.INDEX, elasticsearch_config.TYPE, match_query)
-        doc_list = [self._inflate(d.get('_source')) for d in search_res.get('hits').get('hits')]
-        return doc_list
+        return self._inflate_hits(search_res.get('hits').get('hits'), entity_cache)
 
-    def filter(self):
-        pass
+    def _get_cached_lookup(self, kwargs):
+        """
+        :return: (cache if the lookup is read through the cache else None, <list> of cached entities or None)
+        """
+        entity_cache = cache.get_cache()
+        # Only lookups by uid are read through the cache
+        if entity_cache is None or list(kwargs.keys()) != ['uid'] or not isinstance(kwargs['uid'], str):
+            return None, None
+        d = entity_cache.get(self.cls.__name__, kwargs['uid'])
+        if d is None:
+            return entity_cache, None
+        return entity_cache, [self._inflate(d.get('_source'), d.get('_version'))]
+
+    def _inflate_hits(self, hits, entity_cache=None):
+        if entity_cache is not None and len(hits) == 1:
+            self._cache_document(entity_cache, hits[0])
+        return [self._inflate(d.get('_source'), d.get('_version')) for d in hits]
+
+    def _cache_document(self, entity_cache, d):
+        entity_cache.set(self.cls.__name__, d.get('_source').get('data').get('uid'),
+                         {'_source': d.get('_source'), '_version': d.get('_version')})
+
+    def get_many(self, uids, chunk_size=None):
+        """
+        Gets entities by uid with real-time _mget requests instead of searches
+        :param uids: iterable of uids
+        :param chunk_size: number of documents fetched per request, defaults to the configured size
+        :return: <list> of entities in the order of the uids, None for the uids without an entity of the class
+        """
+        if chunk_size is None:
+            chunk_size = elasticsearch_config.MGET_CHUNK_SIZE
+        uids = list(uids)
+        entities, missing, entity_cache = self._get_cached_entities(uids)
+
+        es_conn = elasticsearch_dao.ElasticsearchDao(elasticsearch_config.HOST, elasticsearch_config.PORT)
+        for start in range(0, len(missing), chunk_size):
+            positions = missing[start:start + chunk_size]
+            docs = es_conn.get_many([uids[position] for position in positions], elasticsearch_config.INDEX,
+                                    elasticsearch_config.TYPE)
+            self._set_fetched_entities(entities, positions, docs, entity_cache)
+        return entities
+
+    def _get_cached_entities(self, uids):
+        """
+        :return: (<list> of the cached entities in the order of the uids, None for the others,
+        <list> of the positions of the uids to fetch, cache)
+        """
+        entities = [None] * len(uids)
+        entity_cache = cache.get_cache()
+        if entity_cache is None:
+            return entities, list(range(len(uids))), None
+
+        missing = []
+        for position, uid in enumerate(uids):
+            d = entity_cache.get(self.cls.__name__, uid)
+            if d is None:
+                missing.append(position)
+            else:
+                entities[position] = self._inflate(d.get('_source'), d.get('_version'))
+        return entities, missing, entity_cache
+
+    def _set_fetched_entities(self, entities, positions, docs, entity_cache):
+        for position, d in zip(positions, docs):
+            source = d.get('_source', {}) if d.get('found') else {}
+            meta = source.get('_meta', {})
+            # Documents of other classes and deleted documents are filtered out, as by searches
+            if meta.get('_class') == self.cls.__name__ and not meta.get('_deleted'):
+                if entity_cache is not None:
+                    self._cache_document(entity_cache, d)
+                entities[position] = self._inflate(source, d.get('_version'))
+
+    def get_by_uid(self, uid):
+        """
+        Gets an entity by uid with a real-time _mget request, see get_many
+        :return: entity, None if there is no entity of the class with the uid
+        """
+        return self.get_many([uid])[0]
+
+    def iter(self, page_size=None, **kwargs):
+        """
+        Lazily iterates over all the entities matching the specified keyword arguments.
+        Pages through the results with search_after, fetching the next page in the background
+        while the current one is consumed
+        :param page_size: number of documents fetched per request, defaults to the configured size
+        :return: generator of matching entities
+        """
+        if page_size is None:
+            page_size = elasticsearch_config.SEARCH_PAGE_SIZE
+        match_query = self._get_iter_query(page_size, kwargs)
+        es_conn = elasticsearch_dao.ElasticsearchDao(elasticsearch_config.HOST, elasticsearch_config.PORT)
+
+        def search(search_after=None):
+            query = match_query if search_after is None else dict(match_query, search_after=search_after)
+            return es_conn.get_connection().search(elasticsearch_config.INDEX, elasticsearch_config.TYPE, query)
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            next_page = executor.submit(search)
+            while next_page is not None:
+                hits = next_page.result().get('hits').get('hits')
+                # A full page means there might be more documents, fetching them while this page is consumed
+                next_page = executor.submit(search, hits[-1].get('sort')) if len(hits) == page_size else None
+                for d in hits:
+                    yield self._inflate(d.get('_source'), d.get('_version'))
+
+    def _get_iter_query(self, page_size, kwargs):
+        match_query = self._get_match_query(kwargs)
+        match_query['size'] = page_size
+        # "data.uid" is the id of the document, which makes the sort a total order for search_after.
+        # Unlike "_uid", it is read from doc values instead of loading fielddata in the heap
+        match_query['sort'] = [self.query_builder.sort('uid')]
+        return match_query
+
+    def _check_entities(self, entities):
+        for entity in entities:
+            if not isinstance(entity, self.cls):
+                raise InvalidTypeError(entity, self.cls)
+            yield entity
+
+    def bulk_save(self, entities, **kwargs):
+        """
+        Saves many entities of the EntitySet class, see StructuredEntity.save_many
+        :return: <list> of (is_saved, response) tuples, in the order of the entities
+        """
+        return self.cls.save_many(self._check_entities(entities), **kwargs)
+
+    def _get_query_set(self):
+        return QuerySet(self)
+
+    def all(self):
+        """
+        Lazy QuerySet of all the entities of the class
+        """
+        return self._get_query_set()
+
+    def filter(self, **kwargs):
+        """
+        Lazy QuerySet of the entities matching all the lookups, see QuerySet.filter
+        """
+        return self._get_query_set().filter(**kwargs)
+
+    def exclude(self, **kwargs):
+        """
+        Lazy QuerySet of the entities not matching the lookups, see QuerySet.exclude
+        """
+        return self._get_query_set().exclude(**kwargs)
+
+    def order_by(self, *fields):
+        """
+        Lazy QuerySet of all the entities sorted on fields, see QuerySet.order_by
+        """
+        return self._get_query_set().order_by(*fields)
+
+
+class AsyncEntitySet(EntitySet):
+    """
+    EntitySet searching elasticsearch with non-blocking requests, for asyncio applications.
+    Many lookups can run concurrently with asyncio.gather
+    """
+
+    def _get_query_set(self):
+        # all, filter, exclude and order_by return an AsyncQuerySet
+        return AsyncQuerySet(self)
+
+    async def get(self, **kwargs):
+        """
+        Searches elasticsearch for specified keyword arguments, see EntitySet.get
+        :return: List of matching entities
+        """
+        entity_cache, doc_list = self._get_cached_lookup(kwargs)
+        if doc_list is not None:
+            return doc_list
+
+        match_query = self._get_match_query(kwargs)
+        es_conn = async_elasticsearch_dao.AsyncElasticsearchDao(elasticsearch_config.HOST, elasticsearch_config.PORT)
+        search_res = await es_conn.get_connection().search(elasticsearch_config.INDEX, elasticsearch_config.TYPE,
+                                                           match_query)
+        return self._inflate_hits(search_res.get('hits').get('hits'), entity_cache)
+
+    async def get_many(self, uids, chunk_size=None):
+        """
+        Gets entities by uid with real-time _mget requests, sent concurrently, see EntitySet.get_many
+        :return: <list> of entities in the order of the uids, None for the uids without an entity of the class
+        """
+        if chunk_size is None:
+            chunk_size = elasticsearch_config.MGET_CHUNK_SIZE
+        uids = list(uids)
+        entities, missing, entity_cache = self._get_cached_entities(uids)
+
+        es_conn = async_elasticsearch_dao.AsyncElasticsearchDao(elasticsearch_config.HOST, elasticsearch_config.PORT)
+        chunks = [missing[start:start + chunk_size] for start in range(0, len(missing), chunk_size)]
+        responses = await asyncio.gather(*[es_conn.get_many([uids[position] for position in positions],
+                                                            elasticsearch_config.INDEX, elasticsearch_config.TYPE)
+                                           for positions in chunks])
+        for positions, docs in zip(chunks, responses):
+            self._set_fetched_entities(entities, positions, docs, entity_cache)
+        return entities
+
+    async def get_by_uid(self, uid):
+        """
+        Gets an entity by uid with a real-time _mget request, see get_many
+        :return: entity, None if there is no entity of the class with the uid
+        """
+        return (await self.get_many([uid]))[0]
+
+    async def iter(self, page_size=None, **kwargs):
+        """
+        Lazily iterates over all the entities matching the specified keyword arguments, see EntitySet.iter.
+        The next page is fetched while the current one is consumed
+        :return: async generator of matching entities
+        """
+        if page_size is None:
+            page_size = elasticsearch_config.SEARCH_PAGE_SIZE
+        match_query = self._get_iter_query(page_size, kwargs)
+        es_conn = async_elasticsearch_dao.AsyncElasticsearchDao(elasticsearch_config.HOST, elasticsearch_config.PORT)
+
+        def search(search_after=None):
+            query = match_query if search_after is None else dict(match_query, search_after=search_after)
+            return asyncio.ensure_future(es_conn.get_connection().search(elasticsearch_config.INDEX,
+                                                                         elasticsearch_config.TYPE, query))
+
+        next_page = search()
+        try:
+            while next_page is not None:
+                hits = (await next_page).get('hits').get('hits')
+                # A full page means there might be more documents, fetching them while this page is consumed
+                next_page = search(hits[-1].get('sort')) if len(hits) == page_size else None
+                for d in hits:
+                    yield self._inflate(d.get('_source'), d.get('_version'))
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+    async def bulk_save(self, entities, **kwargs):
+        """
+        Saves many entities of the EntitySet class, see StructuredEntity.asave_many
+        :return: <list> of (is_saved, response) tuples, in the order of the entities
+        """
+        return await self.cls.asave_many(self._check_entities(entities), **kwargs)
+
+
+class QuerySet(object):
+    """
+    Lazy, chainable query over the entities of an EntitySet.
+    The query is sent to elasticsearch as a single request when the QuerySet is evaluated
+    (iterated, indexed or measured with len) and the results are cached for repeated evaluation
+    """
+
+    def __init__(self, entity_set):
+        self.entity_set = entity_set
+        self.query_builder = entity_set.query_builder
+        self._filters = []
+        self._queries = []
+        self._excludes = []
+        self._sort = []
+        self._from = 0
+        self._size = None
+        self._result_cache = None
+
+    def _clone(self):
+        query_set = self.__class__(self.entity_set)
+        query_set._filters = list(self._filters)
+        query_set._queries = list(self._queries)
+        query_set._excludes = list(self._excludes)
+        query_set._sort = list(self._sort)
+        query_set._from = self._from
+        query_set._size = self._size
+        return query_set
+
+    def _deflate_value(self, key, value):
+        if isinstance(value, (list, tuple)):
+            return [self._deflate_value(key, item) for item in value]
+        if isinstance(value, StructuredEntity):
+            return value.get_value_as_json()
+        if isinstance(value, datetime):
+            return self.entity_set.cls._fields[key.split('__')[0]].deflate(value)
+        return value
+
+    def _get_clauses(self, kwargs):
+        """
+        :return: (<list> of exact clauses for the filter context, <list> of full-text clauses)
+        """
+        filter_clauses = []
+        full_text_clauses = []
+        for key, value in kwargs.items():
+            full_text = self.entity_set._is_full_text(key)
+            clause = self.query_builder.lookup(key, self._deflate_value(key, value), full_text=full_text)
+            if full_text:
+                full_text_clauses.append(clause)
+            else:
+                filter_clauses.append(clause)
+        return filter_clauses, full_text_clauses
+
+    def filter(self, **kwargs):
+        """
+        Keeps the entities matching all the lookups.
+        Lookups are field=value, field__gt, field__gte, field__lt, field__lte for ranges
+        and field__in for a list of values, "__" also separating nested fields (user__name="abc")
+        :return: new QuerySet
+        """
+        query_set = self._clone()
+        filter_clauses, full_text_clauses = self._get_clauses(kwargs)
+        query_set._filters.extend(filter_clauses)
+        query_set._queries.extend(full_text_clauses)
+        return query_set
+
+    def exclude(self, **kwargs):
+        """
+        Removes the entities matching all the lookups, see filter for the lookups
+        :return: new QuerySet
+        """
+        query_set = self._clone()
+        filter_clauses, full_text_clauses = self._get_clauses(kwargs)
+        query_set._excludes.append({"bool": {"must": filter_clauses + full_text_clauses}})
+        return query_set
+
+    def order_by(self, *fields):
+        """
+        Sorts on the fields, a leading "-" meaning descending order (order_by("-age", "name"))
+        :return: new QuerySet
+        """
+        query_set = self._clone()
+        query_set._sort = [self.query_builder.sort(field) for field in fields]
+        return query_set
+
+    def _get_query(self):
+        filters = [self.query_builder.lookup('_class', self.entity_set.cls.__name__),
+                   self.query_builder.lookup('_deleted', False)]
+        # Returning the version of the documents for optimistic concurrency on save
+        query = {"query": {"bool": {"filter": filters + self._filters}}, "version": True}
+        if self._queries:
+            query['query']['bool']['must'] = self._queries
+        if self._excludes:
+            query['query']['bool']['must_not'] = self._excludes
+        if self._sort:
+            query['sort'] = self._sort
+        return query
+
+    def _search(self, **params):
+        es_conn = elasticsearch_dao.ElasticsearchDao(elasticsearch_config.HOST, elasticsearch_config.PORT)
+        return es_conn.get_connection().search(elasticsearch_config.INDEX, elasticsearch_config.TYPE,
+                                               self._get_query(), **params)
+
+    def _get_page_params(self):
+        """
+        :return: "from_" and "size" parameters of the search fetching the results
+        """
+        size = self._size
+        if size is None:
+            if self._from >= elasticsearch_config.MAX_RESULT_WINDOW:
+                raise ValueError('QuerySet offset {} is beyond the result window of {} documents, '
+                                 'use EntitySet.iter to go through all the results'.format(
+                                     self._from, elasticsearch_config.MAX_RESULT_WINDOW))
+            size = elasticsearch_config.MAX_RESULT_WINDOW - self._from
+        return {'from_': self._from, 'size': size}
+
+    def _set_result_cache(self, search_res):
+        self._result_cache = [self.entity_set._inflate(d.get('_source'), d.get('_version'))
+                              for d in search_res.get('hits').get('hits')]
+        return self._result_cache
+
+    def _fetch_all(self):
+        if self._result_cache is None:
+            self._set_result_cache(self._search(**self._get_page_params()))
+        return self._result_cache
+
+    def __iter__(self):
+        return iter(self._fetch_all())
+
+    def __len__(self):
+        return len(self._fetch_all())
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            if item.step is not None:
+                raise ValueError('Slicing with a step is not supported')
+            if (item.start or 0) < 0 or (item.stop is not None and item.stop < 0):
+                raise ValueError('Negative indexing is not supported')
+            if self._result_cache is not None:
+                return self._result_cache[item]
+
+            query_set = self._clone()
+            start = item.start or 0
+            query_set._from = self._from + start
+            if item.stop is not None:
+                stop = item.stop if self._size is None else min(item.stop, self._size)
+                query_set._size = max(stop - start, 0)
+            elif self._size is not None:
+                query_set._size = max(self._size - start, 0)
+            return query_set
+
+        if item < 0:
+            raise ValueError('Negative indexing is not supported')
+        if self._result_cache is not None:
+            return self._result_cache[item]
+        results = list(self[item:item + 1])
+        if not results:
+            raise IndexError('QuerySet index out of range')
+        return results[0]
+
+    def _get_cached_count(self):
+        """
+        :return: number of matching entities known from the results, None if they have to be counted
+        """
+        # The cache is capped by the result window, it only holds all the matches when shorter
+        if self._result_cache is not None and self._from == 0 and self._size is None and \
+                len(self._result_cache) < elasticsearch_config.MAX_RESULT_WINDOW:
+            return len(self._result_cache)
+        return None
+
+    def _get_count_query(self):
+        return {"query": self._get_query()['query']}
+
+    def count(self):
+        """
+        Number of matching entities, the slice of the QuerySet being ignored
+        :return: <int>
+        """
+        cached_count = self._get_cached_count()
+        if cached_count is not None:
+            return cached_count
+        es_conn = elasticsearch_dao.ElasticsearchDao(elasticsearch_config.HOST, elasticsearch_config.PORT)
+        return es_conn.get_connection().count(elasticsearch_config.INDEX, elasticsearch_config.TYPE,
+                                              self._get_count_query())['count']
+
+    def exists(self):
+        """
+        Checks if at least one entity matches, without fetching any document
+        :return: <bool>
+        """
+        if self._result_cache is not None:
+            return len(self._result_cache) > 0
+        search_res = self._search(size=0, terminate_after=1)
+        return search_res.get('hits').get('total') > 0
+
+
+class AsyncQuerySet(QuerySet):
+    """
+    QuerySet of an AsyncEntitySet, evaluated with non-blocking requests: iterated with "async for"
+    and measured with acount and aexists. Slices are new AsyncQuerySets, the blocking evaluations
+    (iteration, len, indexing, count and exists) raise TypeError until the results are fetched
+    """
+
+    async def _asearch(self, **params):
+        es_conn = async_elasticsearch_dao.AsyncElasticsearchDao(elasticsearch_config.HOST, elasticsearch_config.PORT)
+        return await es_conn.get_connection().search(elasticsearch_config.INDEX, elasticsearch_config.TYPE,
+                                                     self._get_query(), **params)
+
+    def _fetch_all(self):
+        if self._result_cache is None:
+            raise TypeError('AsyncQuerySet results are fetched with non-blocking requests, use "async for"')
+        return self._result_cache
+
+    async def _afetch_all(self):
+        if self._result_cache is None:
+            self._set_result_cache(await self._asearch(**self._get_page_params()))
+        return self._result_cache
+
+    async def __aiter__(self):
+        for entity in await self._afetch_all():
+            yield entity
+
+    def count(self):
+        raise TypeError('AsyncQuerySet is counted with a non-blocking request, use "await acount()"')
+
+    def exists(self):
+        raise TypeError('AsyncQuerySet is checked with a non-blocking request, use "await aexists()"')
+
+    async def acount(self):
+        """
+        Number of matching entities, see QuerySet.count
+        :return: <int>
+        """
+        cached_count = self._get_cached_count()
+        if cached_count is not None:
+            return cached_count
+        es_conn = async_elasticsearch_dao.AsyncElasticsearchDao(elasticsearch_config.HOST, elasticsearch_config.PORT)
+        res = await es_conn.get_connection().count(elasticsearch_config.INDEX, elasticsearch_config.TYPE,
+                                                   self._get_count_query())
+        return res['count']
+
+    async def aexists(self):
+        """
+        Checks if at least one entity matches, see QuerySet.exists
+        :return: <bool>
+        """
+        if self._result_cache is not None:
+            return len(self._result_cache) > 0
+        search_res = await self._asearch(size=0, terminate_after=1)
+        return search_res.get('hits').get('total') > 0
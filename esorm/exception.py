@@ -1,5 +1,5 @@
 
-__all__ = ["ValueNotInAllowedValuesError", "InvalidArgumentError", "InvalidTypeError"]
+__all__ = ["ValueNotInAllowedValuesError", "InvalidArgumentError", "InvalidTypeError", "VersionConflictError"]
 
 
 class ValueNotInAllowedValuesError(ValueError):
@@ -19,3 +19,10 @@ class InvalidArgumentError(ValueError):
     def __init__(self, value, cls):
         super().__init__('Argument "{}" not defined in {}'.format(value, cls))
 
+
+class VersionConflictError(Exception):
+
+    def __init__(self, uid, version):
+        super().__init__('Document "{}" was modified concurrently, expected version {}'.format(uid, version))
+        self.uid = uid
+        self.version = version
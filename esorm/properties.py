@@ -1,13 +1,12 @@
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
-import json
 from abc import abstractmethod
 
 from esorm.validator import type_check, validate_json
-from esorm.util import http_request_util
+from esorm.util.allowed_values_util import AllowedValues, AllowedMultiset, get_provider
 from esorm.base import Base
-from esorm.entity import StructuredEntity
+from esorm.entity import StructuredEntity, get_trusted_inflate
 
 
 __all__ = ["StringProperty",
@@ -25,8 +24,13 @@ class BaseProperty(Base):
     Base class for all property types
     """
     data_type = None
+    # Elasticsearch field type, None leaving the field to dynamic mapping
+    mapping_type = None
+    # Values need no conversion between elasticsearch documents and entities
+    passthrough = False
 
-    def __init__(self, default=None, allowed_values=None, allowed_values_from_url=None, **kwargs):
+    def __init__(self, default=None, allowed_values=None, allowed_values_from_url=None, index=True, doc_values=True,
+                 **kwargs):
         super().__init__(default=None, allowed_values=None, allowed_values_from_url=None, **kwargs)
         # If type is not in base types, check for presence of "uid" in kwargs
         if self.__class__.__name__ not in __all__:
@@ -34,15 +38,24 @@ class BaseProperty(Base):
 
         self.has_default = True if default else False
         self.default = default
+        self.index = index
+        self.doc_values = doc_values
 
+        # Values from a URL are only fetched on first validation, defining the property sends no request
+        self.allowed_values_from_url = allowed_values_from_url
+        self._allowed_values_provider = get_provider(allowed_values_from_url) if allowed_values_from_url else None
+        self._allowed_values_revision = None
         if allowed_values is None:
             self.allowed_values = []
-        elif allowed_values_from_url is not None:
-            self.allowed_values = self._get_allowed_values_from_url(allowed_values_from_url)
         else:
             self.allowed_values = allowed_values
+        # Compiled once, validating a value does not scan the list
+        self._compiled_allowed_values = self._compile_allowed_values(self.allowed_values)
 
-        self.set_value(default)
+        # Value of a property used within a JSON object, entities store their values themselves
+        self.value = self.validate_value(default)
+        # Name of the attribute in the entity class, set when the class is defined
+        self.name = None
 
     def _check_for_uid(self, **kwargs):
         if 'uid' not in kwargs.keys():
@@ -50,21 +63,52 @@ class BaseProperty(Base):
         else:
             return True
 
-    @staticmethod
-    def _get_allowed_values_from_url(url):
-        try:
-            res = http_request_util.make_get_request(url=url)
-            if res.status_code == 200:
-                json_response = json.loads(res.content)
-                return json_response.get('allowed_values', [])
-            else:
-                return []
-        except Exception as e:
-            raise e
+    def _compile_allowed_values(self, allowed_values):
+        return AllowedValues(allowed_values)
+
+    @property
+    def _allowed_values(self):
+        """
+        Compiled allowed values, recompiled when the values from the URL were refreshed
+        """
+        provider = self._allowed_values_provider
+        if provider is not None:
+            allowed_values, revision = provider.get()
+            if revision != self._allowed_values_revision:
+                self.allowed_values = allowed_values
+                self._compiled_allowed_values = self._compile_allowed_values(allowed_values)
+                self._allowed_values_revision = revision
+        return self._compiled_allowed_values
 
     def __str__(self):
         return repr(self.value)
 
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        # Unset fields read None as entity fields do, the default being shared by all the instances
+        return instance.value_dict.get(self.name)
+
+    def __set__(self, instance, value):
+        instance.set_value(self.name, value)
+
+    def get_mapping(self):
+        """
+        Elasticsearch mapping of the property, "index" and "doc_values" being disabled when set to False
+        :return: mapping <dict>, None to leave the field to dynamic mapping
+        """
+        if self.mapping_type is None:
+            return None
+        mapping = {"type": self.mapping_type}
+        if not self.index:
+            mapping['index'] = False
+        if not self.doc_values:
+            mapping['doc_values'] = False
+        return mapping
+
     @abstractmethod
     def get_value(self):
         return self.value
@@ -85,8 +129,19 @@ class BaseProperty(Base):
         pass
 
     @abstractmethod
+    def validate_value(self, value):
+        """
+        Validates a value of the property, the property itself does not store it
+        :return: value to store in the entity
+        """
+        return value
+
     def set_value(self, value):
-        self.value = value
+        """
+        Sets the value of a standalone property, such as the properties of a JsonObjectProperty value.
+        Values of entities are set with StructuredEntity.set_value
+        """
+        self.value = self.validate_value(value)
 
 
 class StringProperty(BaseProperty):
@@ -94,14 +149,29 @@ class StringProperty(BaseProperty):
     Stores Strings
     """
     data_type = str
+    mapping_type = 'keyword'
+    passthrough = True
 
-    def __init__(self, default=None, allowed_values=None, **kwargs):
+    def __init__(self, default=None, allowed_values=None, full_text=False, **kwargs):
+        """
+        :param full_text: the value is analyzed text searched with "match" queries,
+        otherwise it is an exact value searched with "term" queries
+        """
         if default is None:
             default = ''
         if allowed_values is None:
             allowed_values = []
+        self.full_text = full_text
         super().__init__(default=default, allowed_values=allowed_values, **kwargs)
 
+    def get_mapping(self):
+        if not self.full_text:
+            return super().get_mapping()
+        mapping = {"type": "text"}
+        if not self.index:
+            mapping['index'] = False
+        return mapping
+
     @type_check(data_type)
     def inflate(self, value):
         """
@@ -114,14 +184,14 @@ class StringProperty(BaseProperty):
         return value
 
     @type_check(data_type)
-    def set_value(self, value):
-        self.value = value
+    def validate_value(self, value):
+        return value
 
     @type_check(data_type)
     def validate_allowed_value(self, value):
-        if self.allowed_values is None or self.allowed_values == []:
+        if not self._allowed_values:
             return True
-        elif value in self.allowed_values:
+        elif value in self._allowed_values:
             return True
         elif value == self.default_value():
             return True
@@ -140,6 +210,8 @@ class IntegerProperty(BaseProperty):
     Stores Integers
     """
     data_type = int
+    mapping_type = 'long'
+    passthrough = True
 
     def __init__(self, default=None, allowed_values=None, **kwargs):
         if allowed_values is None:
@@ -154,25 +226,20 @@ class IntegerProperty(BaseProperty):
     def deflate(self, value):
         return value
 
+    def _compile_allowed_values(self, allowed_values):
+        return AllowedValues(allowed_values, ranges=True)
+
     def default_value(self):
         return self.default if self.has_default else -1
 
     @type_check(data_type)
     def validate_allowed_value(self, value):
-        if self.allowed_values is None or self.allowed_values == []:
-            return True
-        if value in self.allowed_values:
+        if not self._allowed_values:
             return True
-        elif value == self.default_value():
+        # Discrete values and (lower, upper) ranges
+        if value in self._allowed_values:
             return True
-        else:
-            for item in self.allowed_values:
-                if isinstance(item, tuple):
-                    lower_range = item[0]
-                    upper_range = item[1]
-                    if lower_range <= value <= upper_range:
-                        return True
-        return False
+        return value == self.default_value()
 
 
 class FloatProperty(BaseProperty):
@@ -180,6 +247,8 @@ class FloatProperty(BaseProperty):
     Store Float
     """
     data_type = float
+    mapping_type = 'double'
+    passthrough = True
 
     def __init__(self, default=None, allowed_values=None, **kwargs):
         super().__init__(default=default, allowed_values=allowed_values, **kwargs)
@@ -192,25 +261,20 @@ class FloatProperty(BaseProperty):
     def deflate(self, value):
         return value
 
+    def _compile_allowed_values(self, allowed_values):
+        return AllowedValues(allowed_values, ranges=True)
+
     def default_value(self):
         return self.default if self.has_default else float('inf')
 
     @type_check(data_type)
     def validate_allowed_value(self, value):
-        if self.allowed_values is None or self.allowed_values == []:
+        if not self._allowed_values:
             return True
-        if value in self.allowed_values:
+        # Discrete values and (lower, upper) ranges
+        if value in self._allowed_values:
             return True
-        elif value == self.default_value():
-            return True
-        else:
-            for item in self.allowed_values:
-                if isinstance(item, tuple):
-                    lower_range = item[0]
-                    upper_range = item[1]
-                    if lower_range <= value <= upper_range:
-                        return True
-        return False
+        return value == self.default_value()
 
 
 class ArrayProperty(BaseProperty):
@@ -219,7 +283,10 @@ class ArrayProperty(BaseProperty):
     """
     data_type = list
 
-    def __init__(self, default=None, base_property=None, **kwargs):
+    def __init__(self, default=None, base_property=None, nested=False, **kwargs):
+        """
+        :param nested: map the entities of the array as "nested" documents instead of flattened objects
+        """
         if default is None:
             default = []
 
@@ -231,9 +298,27 @@ class ArrayProperty(BaseProperty):
                 raise TypeError('ArrayProperty cannot have nested ArrayProperty')
 
         self.base_property = base_property
+        self.nested = nested
+        self.passthrough = base_property is None or base_property.passthrough
         super().__init__(default, **kwargs)
 
+    def get_mapping(self):
+        # Elasticsearch fields are multi-valued, an array is mapped as its items
+        if self.base_property is None:
+            return None
+        mapping = self.base_property.get_mapping()
+        if self.nested and mapping is not None and mapping.get('type') == 'object':
+            mapping = dict(mapping, type='nested')
+        return mapping
+
+    def _compile_allowed_values(self, allowed_values):
+        return AllowedMultiset(allowed_values)
+
     def add(self, value):
+        """
+        Appends an item to the value of a standalone array property, see set_value
+        """
+        self.validate_value([value])
         self.value.append(value)
 
     def get_value(self):
@@ -247,6 +332,12 @@ class ArrayProperty(BaseProperty):
             return [self.base_property.inflate(item) for item in value]
         return list(value)
 
+    def inflate_trusted(self, value):
+        if self.base_property:
+            inflate = get_trusted_inflate(self.base_property)
+            return [inflate(item) for item in value]
+        return list(value)
+
     def deflate(self, value):
         if self.base_property:
             return [self.base_property.deflate(item) for item in value]
@@ -254,9 +345,10 @@ class ArrayProperty(BaseProperty):
 
     @type_check(data_type)
     def validate_allowed_value(self, value):
-        if self.allowed_values is None or self.allowed_values == []:
+        if not self._allowed_values:
             return True
-        if sorted(value) == sorted(self.allowed_values):
+        # Same items in any order
+        if value in self._allowed_values:
             return True
         elif value == self.default_value():
             return True
@@ -264,12 +356,13 @@ class ArrayProperty(BaseProperty):
             return False
 
     @type_check(data_type)
-    def set_value(self, value):
-        deflated_value = self.deflate(value)
-        if len(value) == 0:
-            self.value = value
+    def validate_value(self, value):
+        # Deflating checks the type of every item
+        self.deflate(value)
+        if len(value) == 0 or self.base_property is None:
+            return value
         elif isinstance(value[0], self.base_property.__class__.data_type):
-            self.value = value
+            return value
         else:
             raise TypeError('Value {} is expected to be of type {}, got {}'.format(
                 str(value[0]), self.base_property.__class__, type(value[0])
@@ -281,6 +374,8 @@ class JsonObjectProperty(BaseProperty):
     Store JSON
     """
     data_type = dict
+    mapping_type = 'object'
+    passthrough = True
 
     @validate_json(BaseProperty)
     def __init__(self, default=None, allowed_values=None, **kwargs):
@@ -289,8 +384,8 @@ class JsonObjectProperty(BaseProperty):
         super().__init__(default=default, allowed_values=allowed_values, **kwargs)
 
     @validate_json(BaseProperty)
-    def set_value(self, value):
-        self.value = value
+    def validate_value(self, value):
+        return value
 
     def _inflate_json(self, value):
         for k, v in value.items():
@@ -305,12 +400,18 @@ class JsonObjectProperty(BaseProperty):
     def get_value_as_json(self):
         return self._inflate_json(self.value)
 
+    def get_mapping(self):
+        # Object fields have no doc values, a not indexed object is stored in _source only
+        if not self.index:
+            return {"type": "object", "enabled": False}
+        return {"type": "object"}
+
     def default_value(self):
         return self.default if self.has_default else {}
 
     @type_check(data_type)
     def validate_allowed_value(self, value):
-        if self.allowed_values is None or self.allowed_values == []:
+        if not self._allowed_values:
             return True
         elif value == self.default_value():
             return True
@@ -322,6 +423,8 @@ class UniqueIdProperty(BaseProperty):
     Store UniqueID as String
     """
     data_type = str
+    mapping_type = 'keyword'
+    passthrough = True
 
     def __init__(self, default=None, **kwargs):
         if default is None:
@@ -332,12 +435,12 @@ class UniqueIdProperty(BaseProperty):
         return self.default if self.has_default else str(uuid.uuid4())
 
     @type_check(str)
-    def set_value(self, value):
-        self.value = value
+    def validate_value(self, value):
+        return value
 
     @type_check(data_type)
     def validate_allowed_value(self, value):
-        if self.allowed_values is None or self.allowed_values == []:
+        if not self._allowed_values:
             return True
         elif value == self.default_value():
             return True
@@ -346,8 +449,10 @@ class UniqueIdProperty(BaseProperty):
 
 class DateTimeProperty(BaseProperty):
     """
-    Store datetime object
+    Store datetime object, as milliseconds since epoch
     """
+    mapping_type = 'date'
+    epoch = datetime(1970, 1, 1, tzinfo=pytz.utc)
 
     def __init__(self, default_now=False, **kwargs):
         if default_now:
@@ -362,27 +467,40 @@ class DateTimeProperty(BaseProperty):
             raise ValueError('datetime object expected, got {0}'.format(value))
         if value.tzinfo:
             value = value.astimezone(pytz.utc)
-            epoch_date = datetime(1970, 1, 1, tzinfo=pytz.utc)
+            epoch_date = self.epoch
         # elif config.FORCE_TIMEZONE:
         #     raise ValueError("Error deflating {} no timezone provided".format(value))
         else:
             # No timezone specified on datetime object.. assuming UTC
             epoch_date = datetime(1970, 1, 1)
-        return float((value - epoch_date).total_seconds())
+        # Whole milliseconds, elasticsearch 5 truncating the decimals of epoch values
+        return (value - epoch_date) // timedelta(milliseconds=1)
 
-    @type_check(float)
+    @type_check((int, float))
     def inflate(self, value):
-        try:
-            epoch = float(value)
-        except ValueError:
-            raise ValueError('float or integer expected, got {0} cant inflate to datetime'.format(value))
-        return datetime.utcfromtimestamp(epoch).replace(tzinfo=pytz.utc)
+        return self.inflate_trusted(value)
+
+    def inflate_trusted(self, value):
+        # Milliseconds are stored as integers, floats being the seconds stored by earlier versions
+        if type(value) is int:
+            return self.epoch + timedelta(milliseconds=value)
+        # Nested entities saved by earlier versions hold ISO strings
+        if isinstance(value, str):
+            value = datetime.fromisoformat(value)
+            if value.tzinfo is None:
+                return value.replace(tzinfo=pytz.utc)
+            return value.astimezone(pytz.utc)
+        return datetime.utcfromtimestamp(value).replace(tzinfo=pytz.utc)
+
+    def get_mapping(self):
+        # Values are deflated to milliseconds since epoch
+        return dict(super().get_mapping(), format='epoch_millis')
 
     def default_value(self):
         return self.default if self.has_default else datetime.utcnow()
 
     def validate_allowed_value(self, value):
-        if self.allowed_values is None or self.allowed_values == []:
+        if not self._allowed_values:
             return True
         elif value == self.default_value():
             return True
@@ -394,6 +512,8 @@ class GeocoordinateProperty(BaseProperty):
     Store Coordinates {"lat": <>, "lon": <>}
     """
     data_type = dict
+    mapping_type = 'geo_point'
+    passthrough = True
 
     def __init__(self, default=None, **kwargs):
         if default:
@@ -406,15 +526,15 @@ class GeocoordinateProperty(BaseProperty):
         super().__init__(default, **kwargs)
 
     @type_check(data_type)
-    def set_value(self, value):
-        self.value = value
+    def validate_value(self, value):
+        return value
 
     def default_value(self):
         return self.default if self.has_default else {"lat": -1.0, "lon": -1.0}
 
     @type_check(data_type)
     def validate_allowed_value(self, value):
-        if self.allowed_values is None or self.allowed_values == []:
+        if not self._allowed_values:
             return True
         elif value == self.default_value():
             return True
@@ -0,0 +1,231 @@
+import logging
+import threading
+import time
+
+from esorm import cache
+from esorm import versioning
+from esorm.config import elasticsearch_config
+from esorm.dao import elasticsearch_dao
+from esorm.util import elasticsearch_query_builder_util
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionPolicy(object):
+    """
+    Versions of a document kept by the compaction of the version index.
+    A version is kept if it is one of the keep_last latest versions, or newer than keep_for seconds,
+    or the latest version of its thin_interval seconds period. Other versions are deleted,
+    the latest version of a document being always kept
+    """
+
+    def __init__(self, keep_last=None, keep_for=None, thin_interval=None):
+        """
+        :param keep_last: number of latest versions kept
+        :param keep_for: seconds during which versions are kept
+        :param thin_interval: seconds of the periods one older version is kept for, older versions being deleted if None
+        """
+        if keep_last is not None and keep_last < 1:
+            raise ValueError('keep_last must be at least 1, found {}'.format(keep_last))
+        if thin_interval is not None and thin_interval <= 0:
+            raise ValueError('thin_interval must be positive, found {}'.format(thin_interval))
+        self.keep_last = keep_last
+        self.keep_for = keep_for
+        self.thin_interval = thin_interval
+
+    def get_expired(self, versions, now=None):
+        """
+        :param versions: <list> of (version number, last modified epoch seconds, key) of the versions of a document
+        :param now: epoch seconds the versions are compared with, defaults to the current time
+        :return: <list> of the keys of the versions to delete
+        """
+        if now is None:
+            now = time.time()
+        expired = []
+        thinned_periods = set()
+        for rank, (version, last_modified, key) in enumerate(sorted(versions, key=lambda v: v[0], reverse=True)):
+            last_modified = last_modified or 0
+            period = None if self.thin_interval is None else int(last_modified // self.thin_interval)
+            if rank == 0 or (self.keep_last is not None and rank < self.keep_last) or \
+                    (self.keep_for is not None and last_modified >= now - self.keep_for):
+                # A kept version is the one of its period, older versions of the period are thinned
+                thinned_periods.add(period)
+                continue
+            if period is not None and period not in thinned_periods:
+                thinned_periods.add(period)
+                continue
+            expired.append(key)
+        return expired
+
+
+def _get_default_policy():
+    if elasticsearch_config.VERSION_KEEP_LAST is None and elasticsearch_config.VERSION_KEEP_FOR is None and \
+            elasticsearch_config.VERSION_THIN_INTERVAL is None:
+        return None
+    return RetentionPolicy(elasticsearch_config.VERSION_KEEP_LAST,
+                           elasticsearch_config.VERSION_KEEP_FOR,
+                           elasticsearch_config.VERSION_THIN_INTERVAL)
+
+
+# Retention policies of the entity classes, keyed by class name
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+def set_retention_policy(entity_class, policy):
+    """
+    Sets the retention policy of the versions of an entity class, overriding the configured policy
+    :param entity_class: StructuredEntity subclass or class name
+    :param policy: RetentionPolicy, None keeping all the versions
+    """
+    class_name = entity_class if isinstance(entity_class, str) else entity_class.__name__
+    with _policies_lock:
+        _policies[class_name] = policy
+
+
+def get_retention_policy(class_name):
+    """
+    :return: RetentionPolicy of the entity class, the configured policy if none was set, None to keep all versions
+    """
+    if class_name in _policies:
+        return _policies[class_name]
+    return _get_default_policy()
+
+
+class VersionCompactor(object):
+    """
+    Deletes the versions expired by the retention policies of the entity classes, a batch of entities at a time:
+    each batch costs one search of the entity index, the searches of the versions of its entities
+    and one _bulk request deleting the expired versions.
+    It can run periodically in a background thread with start
+    """
+
+    def __init__(self, batch_size=None, interval=None):
+        """
+        :param batch_size: number of entities per batch, defaults to the configured size
+        :param interval: seconds between two runs of the background thread, defaults to the configured interval
+        """
+        self.batch_size = elasticsearch_config.COMPACTION_BATCH_SIZE if batch_size is None else batch_size
+        self.interval = elasticsearch_config.COMPACTION_INTERVAL if interval is None else interval
+        self.es_conn = elasticsearch_dao.ElasticsearchDao(elasticsearch_config.HOST, elasticsearch_config.PORT)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _get_entities_query(self, class_names, search_after):
+        query = elasticsearch_query_builder_util.QueryBuilder.filter_match(
+            {} if class_names is None else {'_class__in': class_names})
+        query['_source'] = ['data.uid', '_meta._class']
+        query['size'] = self.batch_size
+        # "data.uid" is the id of the document, read from doc values
+        query['sort'] = [{'data.uid': 'asc'}]
+        if search_after is not None:
+            query['search_after'] = search_after
+        return query
+
+    def _iter_version_hits(self, uids):
+        """
+        :return: generator of the version documents of the uids, with their number and last modification time only
+        """
+        query = elasticsearch_query_builder_util.QueryBuilder.filter_match({'uid__in': uids})
+        query['_source'] = ['data.uid', '_meta._version', '_meta._last_modified']
+        query['size'] = elasticsearch_config.SEARCH_PAGE_SIZE
+        # A version document is unique per uid, version number and index, see versioning._get_versions_query
+        query['sort'] = [{'data.uid': 'asc'}, {versioning.VERSION_FIELD: 'asc'}, {'_index': 'asc'}]
+        while True:
+            res = self.es_conn.get_connection().search(elasticsearch_dao.get_versioning_read_index(),
+                                                       elasticsearch_config.VERSIONING_TYPE,
+                                                       body=query)
+            hits = res.get('hits', {}).get('hits', [])
+            for hit in hits:
+                yield hit
+            if len(hits) < query['size']:
+                break
+            query['search_after'] = hits[-1].get('sort')
+
+    def _compact_batch(self, policies, entities, now, refresh):
+        """
+        :param policies: <dict> of the retention policies of the classes met by the compaction, completed on the way
+        :param entities: <dict> of uid -> class name of the batch
+        :return: number of deleted versions
+        """
+        versions = {}
+        for hit in self._iter_version_hits(list(entities)):
+            source = hit.get('_source', {})
+            uid = source.get('data', {}).get('uid')
+            meta = source.get('_meta', {})
+            versions.setdefault(uid, []).append((meta.get('_version'), meta.get('_last_modified'), hit))
+
+        actions = []
+        entity_cache = cache.get_cache()
+        for uid, uid_versions in versions.items():
+            class_name = entities.get(uid)
+            if class_name not in policies:
+                policies[class_name] = get_retention_policy(class_name)
+            policy = policies[class_name]
+            if policy is None:
+                continue
+            for hit in policy.get_expired(uid_versions, now):
+                actions.append(({'delete': {'_index': hit.get('_index'),
+                                            '_type': hit.get('_type', elasticsearch_config.VERSIONING_TYPE),
+                                            '_id': hit.get('_id')}}, None))
+                if entity_cache is not None:
+                    entity_cache.invalidate(class_name, uid,
+                                            hit.get('_source', {}).get('_meta', {}).get('_version'))
+        if not actions:
+            return 0
+        items = self.es_conn.bulk(actions, refresh=refresh)
+        return sum(1 for item in items if next(iter(item.values())).get('found'))
+
+    def compact(self, class_names=None, refresh=None):
+        """
+        Deletes the expired versions of the entities of the classes
+        :param class_names: names of the entity classes, defaults to the classes with a retention policy,
+        or to all classes when a retention policy is configured
+        :param refresh: refresh policy ("none", "wait_for" or "immediate"), defaults to the configured policy
+        :return: <dict> of the number of compacted entities and deleted versions
+        """
+        now = time.time()
+        if class_names is None and _get_default_policy() is None:
+            class_names = [name for name, policy in list(_policies.items()) if policy is not None]
+            if not class_names:
+                return {'entities': 0, 'deleted': 0}
+        policies = {}
+
+        stats = {'entities': 0, 'deleted': 0}
+        search_after = None
+        while True:
+            res = self.es_conn.get_connection().search(elasticsearch_config.INDEX,
+                                                       elasticsearch_config.TYPE,
+                                                       body=self._get_entities_query(class_names, search_after))
+            hits = res.get('hits', {}).get('hits', [])
+            entities = {hit.get('_source', {}).get('data', {}).get('uid'):
+                        hit.get('_source', {}).get('_meta', {}).get('_class') for hit in hits}
+            if entities:
+                stats['deleted'] += self._compact_batch(policies, entities, now, refresh)
+                stats['entities'] += len(entities)
+            if len(hits) < self.batch_size:
+                break
+            search_after = hits[-1].get('sort')
+        return stats
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                stats = self.compact()
+                logger.info('Compacted the versions of %s entities, %s versions deleted',
+                            stats['entities'], stats['deleted'])
+            except Exception as e:
+                logger.warning('Could not compact the versions: %s', e)
+
+    def start(self):
+        """
+        Runs the compaction every interval seconds in a background thread
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
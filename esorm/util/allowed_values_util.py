@@ -0,0 +1,257 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_right
+
+from esorm.config import elasticsearch_config
+from esorm.util import http_request_util
+
+logger = logging.getLogger(__name__)
+
+
+class AllowedValues(object):
+    """
+    Allowed values of a property, compiled for constant time lookups of the discrete values
+    and logarithmic time lookups of the (lower, upper) ranges
+    """
+
+    def __init__(self, allowed_values, ranges=False):
+        """
+        :param allowed_values: <list> of allowed values
+        :param ranges: tuples of the list are inclusive (lower, upper) ranges instead of discrete values
+        """
+        self.values = set()
+        # Unhashable values, such as JSON objects, are compared one by one
+        self.unhashable_values = []
+        intervals = []
+        for item in allowed_values or []:
+            if ranges and isinstance(item, tuple):
+                intervals.append((item[0], item[1]))
+            else:
+                try:
+                    self.values.add(item)
+                except TypeError:
+                    self.unhashable_values.append(item)
+
+        self.lowers, self.uppers = self._merge_intervals(intervals)
+
+    @staticmethod
+    def _merge_intervals(intervals):
+        """
+        Sorts and merges the overlapping ranges, so that a value can only fall in the range found with bisect
+        :return: (<list> of lower bounds, <list> of upper bounds)
+        """
+        lowers = []
+        uppers = []
+        for lower, upper in sorted(intervals):
+            if lower > upper:
+                continue
+            if uppers and lower <= uppers[-1]:
+                uppers[-1] = max(uppers[-1], upper)
+            else:
+                lowers.append(lower)
+                uppers.append(upper)
+        return lowers, uppers
+
+    def __contains__(self, value):
+        try:
+            if value in self.values:
+                return True
+        except TypeError:
+            return value in self.unhashable_values
+        if self.unhashable_values and value in self.unhashable_values:
+            return True
+        if self.lowers:
+            position = bisect_right(self.lowers, value) - 1
+            return position >= 0 and value <= self.uppers[position]
+        return False
+
+    def __bool__(self):
+        return bool(self.values or self.unhashable_values or self.lowers)
+
+
+class AllowedMultiset(object):
+    """
+    Allowed values of an array property, an array being allowed if it has the same items, in any order
+    """
+
+    def __init__(self, allowed_values):
+        allowed_values = list(allowed_values or [])
+        try:
+            self.counter = collections.Counter(allowed_values)
+            self.sorted_values = None
+        except TypeError:
+            # Unhashable items, such as JSON objects, are compared as a sorted list
+            self.counter = None
+            self.sorted_values = sorted(allowed_values)
+        self.length = len(allowed_values)
+
+    def __contains__(self, value):
+        if len(value) != self.length:
+            return False
+        if self.counter is not None:
+            try:
+                return collections.Counter(value) == self.counter
+            except TypeError:
+                return False
+        return sorted(value) == self.sorted_values
+
+    def __bool__(self):
+        return self.length > 0
+
+
+class AllowedValuesProvider(object):
+    """
+    Allowed values fetched from a URL, from the "allowed_values" key of its JSON response.
+    Values are fetched on first use instead of when the property is defined, then refreshed in the background
+    once older than the TTL, with If-None-Match when the URL returned an ETag.
+    The last fetched values are saved on disk and used when the URL cannot be reached
+    """
+
+    def __init__(self, url, ttl=None, snapshot_dir=None, timeout=None):
+        """
+        :param url: URL of the allowed values
+        :param ttl: seconds before the values are refreshed, defaults to the configured TTL
+        :param snapshot_dir: directory of the snapshot, defaults to the configured directory, None disabling it
+        :param timeout: timeout in seconds of the requests, defaults to the configured timeout
+        """
+        self.url = url
+        self.ttl = elasticsearch_config.ALLOWED_VALUES_TTL if ttl is None else ttl
+        self.snapshot_dir = elasticsearch_config.ALLOWED_VALUES_SNAPSHOT_DIR if snapshot_dir is None else snapshot_dir
+        self.timeout = elasticsearch_config.ALLOWED_VALUES_TIMEOUT if timeout is None else timeout
+
+        self.values = None
+        self.etag = None
+        # Incremented every time the values change, for the properties to recompile them
+        self.revision = 0
+        self.fetched_at = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+        # Set once the first fetch is over, the concurrent first calls waiting for it
+        self._loaded = threading.Event()
+
+    def _get_snapshot_path(self):
+        if not self.snapshot_dir:
+            return None
+        return os.path.join(self.snapshot_dir, hashlib.sha1(self.url.encode('utf-8')).hexdigest() + '.json')
+
+    def _load_snapshot(self):
+        path = self._get_snapshot_path()
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with open(path) as snapshot_file:
+                return json.load(snapshot_file)
+        except (IOError, ValueError):
+            logger.warning('Invalid allowed values snapshot %s', path)
+            return None
+
+    def _save_snapshot(self, values, etag):
+        path = self._get_snapshot_path()
+        if path is None:
+            return
+        try:
+            # Only readable by the user, the snapshots being trusted as allowed values
+            os.makedirs(self.snapshot_dir, mode=0o700, exist_ok=True)
+            # Written to a temporary file first, a concurrent reader never sees a partial snapshot
+            temp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(temp_path, 'w') as snapshot_file:
+                json.dump({'url': self.url, 'etag': etag, 'allowed_values': values}, snapshot_file)
+            os.replace(temp_path, path)
+        except (IOError, OSError, TypeError):
+            logger.warning('Could not save the allowed values snapshot %s', path)
+
+    def _set_values(self, values, etag):
+        with self._lock:
+            self.values = values
+            self.etag = etag
+            self.revision += 1
+
+    def refresh(self):
+        """
+        Fetches the values from the URL, keeping the current or snapshot values if it cannot be reached
+        :return: <bool> True if the values were fetched or confirmed unchanged
+        """
+        headers = {'If-None-Match': self.etag} if self.etag and self.values is not None else None
+        try:
+            res = http_request_util.make_get_request(url=self.url, headers=headers, timeout=self.timeout)
+        except Exception as e:
+            logger.warning('Could not fetch the allowed values from %s: %s', self.url, e)
+            res = None
+
+        if res is not None and res.status_code == 304:
+            self.fetched_at = time.time()
+            return True
+        if res is not None and res.status_code == 200:
+            try:
+                values = json.loads(res.content).get('allowed_values', [])
+            except ValueError:
+                logger.warning('Invalid allowed values returned by %s', self.url)
+            else:
+                etag = res.headers.get('ETag')
+                self._set_values(values, etag)
+                self.fetched_at = time.time()
+                self._save_snapshot(values, etag)
+                return True
+
+        if self.values is None:
+            snapshot = self._load_snapshot() or {}
+            self._set_values(snapshot.get('allowed_values', []), snapshot.get('etag'))
+        # Retried after the TTL rather than on every validation
+        self.fetched_at = time.time()
+        return False
+
+    def _refresh_exclusively(self):
+        """
+        Refreshes the values once _refreshing was set by the caller, for the next expired call to refresh them again
+        """
+        try:
+            self.refresh()
+        finally:
+            self._refreshing = False
+            self._loaded.set()
+
+    def get(self):
+        """
+        Current allowed values, fetched on first call and refreshed in the background once expired
+        :return: (<list> of allowed values, revision)
+        """
+        if self.values is None:
+            # Only the first call fetches the values, concurrent first calls waiting for it
+            with self._lock:
+                first_load = not self._refreshing and self.values is None
+                if first_load:
+                    self._refreshing = True
+            if first_load:
+                self._refresh_exclusively()
+            else:
+                self._loaded.wait()
+        elif time.time() - self.fetched_at > self.ttl and not self._refreshing:
+            with self._lock:
+                start_refresh = not self._refreshing
+                self._refreshing = True
+            if start_refresh:
+                threading.Thread(target=self._refresh_exclusively, daemon=True).start()
+        return self.values or [], self.revision
+
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+def get_provider(url):
+    """
+    Allowed values provider of a URL, shared by all the properties of the process
+    :return: AllowedValuesProvider
+    """
+    provider = _providers.get(url)
+    if provider is None:
+        with _providers_lock:
+            provider = _providers.get(url)
+            if provider is None:
+                provider = _providers[url] = AllowedValuesProvider(url)
+    return provider
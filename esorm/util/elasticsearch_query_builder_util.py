@@ -2,6 +2,9 @@ class QueryBuilder(object):
     """
     Elasticsearch query builder module
     """
+    # Lookups appended to the field name with "__", e.g. age__gte=18
+    RANGE_LOOKUPS = ('gt', 'gte', 'lt', 'lte')
+    LOOKUPS = RANGE_LOOKUPS + ('in',)
 
     def __init__(self):
         pass
@@ -35,6 +38,80 @@ class QueryBuilder(object):
                 item['query']['bool']['must'].append({"match": {'data.' + key: value}})
         return item
 
+    @staticmethod
+    def field_path(field):
+        """
+        Path of a field in the elasticsearch document, "__" separating nested fields
+        """
+        path = field.replace('__', '.')
+        return '_meta.' + path if field.startswith('_') else 'data.' + path
+
+    @staticmethod
+    def lookup(key, value, full_text=False):
+        """
+        Creates the query clause of a lookup such as name="abc", age__gte=18 or uid__in=["a", "b"].
+        Exact lookups are "term"/"terms" clauses, meant for the filter context, unless the field is full-text
+        :param full_text: the field is analyzed full-text, matched with "match" clauses
+        :return: ES DSL query clause
+        """
+        if key == 'geo_near':
+            return QueryBuilder._create_geo_near_query(value)['filter']
+
+        field, lookup = key, None
+        parts = key.rsplit('__', 1)
+        if len(parts) == 2 and parts[1] in QueryBuilder.LOOKUPS:
+            field, lookup = parts
+
+        if full_text:
+            path = QueryBuilder.field_path(field)
+            if lookup is None:
+                return {"match": {path: value}}
+            elif lookup == 'in':
+                return {"bool": {
+                    "should": [{"match": {path: item}} for item in value],
+                    "minimum_should_match": 1
+                }}
+
+        path = QueryBuilder.field_path(field)
+        if lookup is None:
+            return {"term": {path: value}}
+        elif lookup in QueryBuilder.RANGE_LOOKUPS:
+            return {"range": {path: {lookup: value}}}
+        else:
+            return {"terms": {path: list(value)}}
+
+    @staticmethod
+    def filter_match(kwargs, full_text_fields=()):
+        """
+        Creates a "bool" query to match all kwargs, exact lookups being non-scoring (and cacheable)
+        "filter" clauses and lookups on full-text fields being "must" match clauses
+        :param full_text_fields: lookups on analyzed full-text fields
+        :return: ES DSL query
+        """
+        filter_clauses = []
+        must_clauses = []
+        for key, value in kwargs.items():
+            full_text = key in full_text_fields
+            clause = QueryBuilder.lookup(key, value, full_text=full_text)
+            if full_text:
+                must_clauses.append(clause)
+            else:
+                filter_clauses.append(clause)
+
+        item = {"query": {"bool": {"filter": filter_clauses}}}
+        if must_clauses:
+            item['query']['bool']['must'] = must_clauses
+        return item
+
+    @staticmethod
+    def sort(field):
+        """
+        Creates the sort clause of a field, a leading "-" meaning descending order
+        """
+        if field.startswith('-'):
+            return {QueryBuilder.field_path(field[1:]): 'desc'}
+        return {QueryBuilder.field_path(field): 'asc'}
+
     @staticmethod
     def match(doc_dict):
         return {"query": {"match": doc_dict}}
@@ -9,8 +9,8 @@ def make_post_request(url, data=None, headers=None):
     return r.post(url, data=data, headers=headers)
 
 
-def make_get_request(url, params=None, headers=None):
-    return r.get(url, params=params, headers=headers)
+def make_get_request(url, params=None, headers=None, timeout=None):
+    return r.get(url, params=params, headers=headers, timeout=timeout)
 
 
 def join_urls(*args):
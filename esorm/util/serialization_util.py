@@ -0,0 +1,121 @@
+import json
+import uuid
+from datetime import date, datetime
+from decimal import Decimal
+
+from elasticsearch.exceptions import SerializationError
+
+from esorm.config import elasticsearch_config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def _default(data):
+    """
+    JSON value of the types the JSON libraries do not serialize, as the elasticsearch client does
+    """
+    if isinstance(data, (date, datetime)):
+        return data.isoformat()
+    elif isinstance(data, Decimal):
+        return float(data)
+    elif isinstance(data, uuid.UUID):
+        return str(data)
+    raise TypeError("Unable to serialize {!r} (type: {})".format(data, type(data)))
+
+
+class JsonSerializer(object):
+    """
+    Serializer of the elasticsearch requests and responses, using the fastest JSON library installed:
+    orjson, then ujson, then the standard library
+    """
+    mimetype = 'application/json'
+
+    def __init__(self, library=None):
+        """
+        :param library: "orjson", "ujson" or "json", defaults to the configured library, "auto" picking the fastest
+        """
+        if library is None:
+            library = elasticsearch_config.JSON_LIBRARY
+        if library == 'auto':
+            library = 'orjson' if orjson is not None else 'ujson' if ujson is not None else 'json'
+        if library not in ('orjson', 'ujson', 'json'):
+            raise ValueError('Invalid JSON library "{}", expected one of "auto", "orjson", "ujson", "json"'.format(
+                library))
+        if library == 'orjson' and orjson is None or library == 'ujson' and ujson is None:
+            raise ImportError('JSON library "{}" is not installed'.format(library))
+        self.library = library
+
+    def _dumps_bytes(self, data, sort_keys):
+        if self.library == 'orjson':
+            option = orjson.OPT_NON_STR_KEYS
+            if sort_keys:
+                option |= orjson.OPT_SORT_KEYS
+            try:
+                return orjson.dumps(data, default=_default, option=option)
+            except orjson.JSONEncodeError:
+                # orjson is stricter than the standard library, e.g. with integers beyond 64 bits
+                pass
+        elif self.library == 'ujson':
+            try:
+                return ujson.dumps(data, default=_default, ensure_ascii=False, sort_keys=sort_keys).encode('utf-8')
+            except (TypeError, OverflowError):
+                pass
+        return json.dumps(data, default=_default, ensure_ascii=False, sort_keys=sort_keys,
+                          separators=(',', ':')).encode('utf-8')
+
+    def dumps_bytes(self, data, sort_keys=False):
+        """
+        Serializes to UTF-8 encoded JSON, strings and bytes being sent as they are
+        :param sort_keys: sorts the keys of the objects, for a canonical serialization
+        :return: <bytes>
+        """
+        if isinstance(data, bytes):
+            return data
+        if isinstance(data, str):
+            return data.encode('utf-8')
+        try:
+            return self._dumps_bytes(data, sort_keys)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(data, e)
+
+    def dumps(self, data, sort_keys=False):
+        """
+        Serializes to JSON, strings being sent as they are
+        :param sort_keys: sorts the keys of the objects, for a canonical serialization
+        :return: <str>
+        """
+        if isinstance(data, str):
+            return data
+        return self.dumps_bytes(data, sort_keys).decode('utf-8')
+
+    def loads(self, s):
+        try:
+            if self.library == 'orjson':
+                return orjson.loads(s)
+            elif self.library == 'ujson':
+                return ujson.loads(s)
+            return json.loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
+
+
+_serializer = None
+
+
+def get_serializer():
+    """
+    Serializer shared by the process, created on first use
+    :return: JsonSerializer
+    """
+    global _serializer
+    if _serializer is None:
+        _serializer = JsonSerializer()
+    return _serializer
@@ -1,6 +1,291 @@
+import hashlib
+from itertools import islice
+
+import elasticsearch
+
+from esorm import cache
+from esorm.exception import VersionConflictError
 from esorm.dao import elasticsearch_dao
+from esorm.dao import async_elasticsearch_dao
 from esorm.config import elasticsearch_config
 from esorm.util import elasticsearch_query_builder_util
+from esorm.util import serialization_util
+
+
+def get_hash(data):
+    """
+    Content hash of the "data" of a document, used to detect unchanged documents without fetching them
+    :return: hex digest <str>
+    """
+    # Serialized as sent to elasticsearch, datetimes of nested entities included, with sorted keys
+    serialized = serialization_util.get_serializer().dumps_bytes(data, sort_keys=True)
+    return hashlib.sha1(serialized).hexdigest()
+
+
+# Result of the insertion of a document which did not change
+UNCHANGED_RESULT = (False, {'message': 'Document already exists with same ID and data'})
+
+# Script marking a document as deleted, in the main index and in the version index
+DELETE_SCRIPT = {
+    "lang": "painless",
+    "inline": "ctx._source._meta._deleted = true"
+}
+
+
+def _get_update_body(document, fields):
+    """
+    Partial update of the modified fields of "data" and of "_meta"
+    """
+    # A script replaces the values, where a partial "doc" would merge the JSON objects
+    return {
+        "script": {
+            "lang": "painless",
+            "inline": "ctx._source.data.putAll(params.data); ctx._source._meta.putAll(params.meta)",
+            "params": {
+                "data": {field: document.get('data').get(field) for field in fields},
+                "meta": document.get('_meta')
+            }
+        }
+    }
+
+
+def get_version_id(uid, version):
+    """
+    Id of a version document, at most one document being created per uid and version
+    """
+    return '{}_{}'.format(uid, version)
+
+
+def _get_version_action(op_type, index, uid, version, **meta):
+    action = {'_index': index,
+              '_type': elasticsearch_config.VERSIONING_TYPE,
+              '_id': get_version_id(uid, version)}
+    action.update(meta)
+    return {op_type: action}
+
+
+def _get_write_actions(document, version, fields=None):
+    """
+    Bulk actions writing the document into the main index and its version into the version index in one _bulk.
+    The main index write is conditional on "version", its resulting version being predicted
+    as the next one and set in "_meta._version" of the document
+    :param version: version of the stored document, None to create the document
+    :param fields: modified fields of "data" written with a partial update, the whole document being written if None
+    :return: (main index action, document), (version index action, document)
+    """
+    uid = document.get('data').get('uid')
+    meta = {'_index': elasticsearch_config.INDEX, '_type': elasticsearch_config.TYPE, '_id': uid}
+    if version is not None:
+        meta['_version'] = version
+    document['_meta']['_version'] = 1 if version is None else version + 1
+
+    if fields is not None:
+        main_action = ({'update': meta}, _get_update_body(document, fields))
+    else:
+        main_action = ({'create' if version is None else 'index': meta}, document)
+    version_index = elasticsearch_dao.get_versioning_index(document['_meta'].get('_last_modified'))
+    return main_action, (_get_version_action('create', version_index, uid, document['_meta']['_version']), document)
+
+
+def _get_repair_actions(document, main_item, version_item):
+    """
+    Bulk actions correcting the version index after the writes of _get_write_actions, as the actions
+    of a _bulk are not applied atomically: the version of a failed main index write is deleted, and the
+    version is written again if its creation failed or if the main index write resulted in another version.
+    Deletions are conditional on the version document being unchanged since, not to remove the same version
+    written meanwhile by the concurrent save which won the main index write
+    :return: <list> of (action, document) pairs, usually empty
+    """
+    main_response = next(iter(main_item.values()))
+    version_response = next(iter(version_item.values()))
+    uid = document.get('data').get('uid')
+    version_index = elasticsearch_dao.get_versioning_index(document['_meta'].get('_last_modified'))
+    version_created = 'error' not in version_response
+    repairs = []
+
+    if version_created and ('error' in main_response or
+                            main_response.get('_version') != document['_meta']['_version']):
+        repairs.append((_get_version_action('delete', version_response.get('_index', version_index), uid,
+                                            document['_meta']['_version'],
+                                            _version=version_response.get('_version')), None))
+    if 'error' not in main_response and (not version_created or repairs):
+        document['_meta']['_version'] = main_response.get('_version')
+        repairs.append((_get_version_action('index', version_index, uid, document['_meta']['_version']), document))
+    return repairs
+
+
+def _get_write_responses(main_item, version_item, repairs, repair_items):
+    """
+    :return: (main index response, response of the last write of the version)
+    """
+    if repairs and 'index' in repairs[-1][0]:
+        version_item = repair_items[-1]
+    return next(iter(main_item.values())), next(iter(version_item.values()))
+
+
+def _raise_write_error(uid, version, response):
+    """
+    Raises the exception of the elasticsearch client for a failed bulk action,
+    VersionConflictError for a conflict of the main index with a known version
+    """
+    status = response.get('status')
+    if status == 409 and version is not None:
+        raise VersionConflictError(uid, version)
+    error = response.get('error')
+    if isinstance(error, dict):
+        error = error.get('type', error)
+    raise elasticsearch.exceptions.HTTP_EXCEPTIONS.get(status, elasticsearch.TransportError)(status, error, response)
+
+
+def _is_existing_document(version, response):
+    """
+    :return: True if the main index write of a document without known version failed as the document exists
+    """
+    return response.get('status') == 409 and version is None
+
+
+def _is_unchanged(document, current_doc):
+    """
+    :param current_doc: stored document, with at least its "_meta._hash"
+    :return: True if the stored document has the same content as the document
+    """
+    return current_doc.get('_source', {}).get('_meta', {}).get('_hash') == document.get('_meta').get('_hash')
+
+
+def _get_write_result(uid, version, main_response, version_response):
+    """
+    Result of the writes of a document, raising the error of a failed main index write,
+    or of the version write when it failed again after its repair, the document being saved without its version
+    :return: (True, version response)
+    """
+    if 'error' in main_response:
+        _raise_write_error(uid, version, main_response)
+    if 'error' in version_response:
+        _raise_write_error(uid, None, version_response)
+    return True, version_response
+
+
+def _get_batch_actions(documents, current_docs, results):
+    """
+    Bulk actions writing the changed documents of a batch and their versions, conditionally on the current docs.
+    Results of the unchanged documents are set in "results"
+    :return: (<list> of (action, document) pairs, two per written document,
+    <list> of the positions of the written documents)
+    """
+    actions = []
+    changed = []
+    for position, (document, current_doc) in enumerate(zip(documents, current_docs)):
+        if not current_doc.get('found'):
+            version = None
+        elif _is_unchanged(document, current_doc):
+            results[position] = UNCHANGED_RESULT
+            continue
+        else:
+            # Conditional write, failing with a conflict if the document changed since the _mget
+            version = current_doc.get('_version')
+        actions.extend(_get_write_actions(documents[position], version))
+        changed.append(position)
+    return actions, changed
+
+
+def _get_batch_repairs(documents, changed, items):
+    """
+    :return: <list> of (position, main item, version item, repair actions) of the written documents
+    """
+    return [(position, items[2 * i], items[2 * i + 1],
+             _get_repair_actions(documents[position], items[2 * i], items[2 * i + 1]))
+            for i, position in enumerate(changed)]
+
+
+def _set_batch_results(batch_repairs, repair_items, results):
+    repair_items = iter(repair_items)
+    for position, main_item, version_item, repairs in batch_repairs:
+        main_response, version_response = _get_write_responses(main_item, version_item, repairs,
+                                                               [next(repair_items) for _ in repairs])
+        if 'error' in main_response:
+            results[position] = (False, main_response)
+        else:
+            results[position] = ('error' not in version_response, version_response)
+
+
+def _get_by_query_refresh(refresh):
+    # The by query APIs only refresh immediately or not at all
+    return elasticsearch_dao.get_refresh_param(refresh) != 'false'
+
+
+def _get_delete_versions_body(uid):
+    body = elasticsearch_query_builder_util.QueryBuilder.filter_match({'uid': uid})
+    body['script'] = DELETE_SCRIPT
+    return body
+
+
+# Field of the version number of a document
+VERSION_FIELD = '_meta._version'
+
+
+def _get_versions_query(uid, page_size, search_after=None):
+    """
+    Query of a page of the version numbers of a document, in ascending order.
+    Only the version number of the version documents is fetched
+    """
+    query = elasticsearch_query_builder_util.QueryBuilder.filter_match({'uid': uid})
+    query['_source'] = [VERSION_FIELD]
+    query['size'] = page_size
+    # The id of a version document is unique in its index, the index breaking the ties between duplicated
+    # versions, which makes the sort a total order for search_after
+    query['sort'] = [{VERSION_FIELD: 'asc'}, {'_index': 'asc'}]
+    if search_after is not None:
+        query['search_after'] = search_after
+    return query
+
+
+def _get_version_count_query(uid):
+    query = elasticsearch_query_builder_util.QueryBuilder.filter_match({'uid': uid})
+    query['size'] = 0
+    query['aggs'] = {'version_count': {'value_count': {'field': VERSION_FIELD}}}
+    return query
+
+
+def _get_version_count(res):
+    return int(res.get('aggregations', {}).get('version_count', {}).get('value', 0))
+
+
+def _get_versions_page(res, page_size):
+    """
+    :param res: search response of _get_versions_query
+    :return: (<list> of version numbers, search_after of the next page or None if this page is the last one)
+    """
+    hits = res.get('hits', {}).get('hits', [])
+    versions = [d.get('_source').get('_meta').get('_version') for d in hits]
+    return versions, hits[-1].get('sort') if len(hits) == page_size else None
+
+
+def _get_version_query(uid, version):
+    return elasticsearch_query_builder_util.QueryBuilder.filter_match({'uid': uid, '_version': version})
+
+
+def _get_version_doc(res):
+    """
+    :param res: search response of _get_version_query
+    :return: version document, empty if not found
+    """
+    if res and isinstance(res, dict):
+        doc_list = res.get('hits', {}).get('hits', [])
+        if len(doc_list) == 0:
+            return {}
+        elif len(doc_list) > 1:
+            raise IndexError("Too many values in the list, should be only 1")
+        else:
+            return doc_list[0]
+
+
+def _get_version_search_index(last_modified=None):
+    """
+    Index searched for a version, the partition of its modification time when known
+    """
+    if last_modified is None:
+        return elasticsearch_dao.get_versioning_read_index()
+    return elasticsearch_dao.get_versioning_index(last_modified)
 
 
 class Version(object):
@@ -13,132 +298,183 @@ class Version(object):
             elasticsearch_config.HOST,
             elasticsearch_config.PORT)
 
-    def _exists(self, id):
+    def _get_doc_by_id(self, id, **params):
+        return self.es_conn.get_connection().get(index=elasticsearch_config.INDEX, id=id, **params)
+
+    def _write(self, document, version, refresh, fields=None):
         """
-        Check if the document with "id" already exists or not
-        :return: 
+        Writes the document into the main index and its version into the version index with a single _bulk,
+        a second _bulk correcting the version index only when the main index write failed or resulted in
+        another version than the predicted one
+        :return: (main index response, version response)
         """
-        return self.es_conn.get_connection().exists(index=elasticsearch_config.INDEX,
-                                                    doc_type=elasticsearch_config.TYPE,
-                                                    id=id)
+        self.es_conn.ensure_mapping(elasticsearch_config.INDEX, elasticsearch_config.TYPE)
+        self.es_conn.ensure_versioning_mapping()
 
-    def _get_doc_by_id(self, id):
-        return self.es_conn.get_connection().get(index=elasticsearch_config.INDEX, id=id)
+        main_item, version_item = self.es_conn.bulk(_get_write_actions(document, version, fields), refresh=refresh)
+        repairs = _get_repair_actions(document, main_item, version_item)
+        repair_items = self.es_conn.bulk(repairs, refresh=refresh) if repairs else []
+        return _get_write_responses(main_item, version_item, repairs, repair_items)
 
-    def _insert_as_version(self, doc, upsert=True):
-        return self.es_conn.insert_one(doc,
-                                       elasticsearch_config.VERSIONING_INDEX,
-                                       elasticsearch_config.VERSIONING_TYPE,
-                                       id=doc.get('data').get('uid'),
-                                       upsert=upsert)
-
-    def insert(self, document):
+    def insert(self, document, refresh=None, version=None):
         """
-        Inserts and versions the document
-        :param document: JSON document
+        Inserts and versions the document with a single _bulk request. The write on the main index is conditional,
+        the document being written only if the stored document is still at "version", concurrent
+        changes raising VersionConflictError instead of being overwritten.
+        A version which could not be written, even by the repair, raises the exception of the elasticsearch client
+        :param document: JSON document, with the content hash in "_meta._hash"
+        :param refresh: refresh policy ("none", "wait_for" or "immediate"), defaults to the configured policy
+        :param version: version of the stored document the changes are based on, None if unknown
         :return: Insertion response
         """
         uid = document.get('data', {}).get('uid')
 
-        if not self._exists(uid):
-            insertion_response = self.es_conn.insert_one(document,
-                                                         elasticsearch_config.INDEX,
-                                                         elasticsearch_config.TYPE,
-                                                         document.get('data').get('uid'))
-            version = insertion_response.get('_version')
-            item = document.copy()
-            item['_meta'].update({'_version': version})
-            version_insert_response = self._insert_as_version(item, upsert=False)
-            return True, version_insert_response
-        else:
-            doc = self._get_doc_by_id(uid).get('_source')
-            if doc.get('data') == document.get('data'):
-                return False, {'message': 'Document already exists with same ID and data'}
-            else:
-                insertion_response = self.es_conn.insert_one(document,
-                                                             elasticsearch_config.INDEX,
-                                                             elasticsearch_config.TYPE,
-                                                             document.get('data').get('uid'))
-                version = insertion_response.get('_version')
-                document['_meta'].update({'_version': version})
-                version_insert_response = self._insert_as_version(document, upsert=False)
-                return True, version_insert_response
-
-    def delete(self, uid):
-        """
-        Deletes the Entity as well it's all versions
+        insertion_response, version_insert_response = self._write(document, version, refresh)
+        if _is_existing_document(version, insertion_response):
+            # Document already exists, only its hash is fetched to detect unchanged data
+            doc = self._get_doc_by_id(uid, _source_include='_meta._hash')
+            if _is_unchanged(document, doc):
+                return UNCHANGED_RESULT
+            return self.insert(document, refresh, doc.get('_version'))
+        return _get_write_result(uid, version, insertion_response, version_insert_response)
+
+    def update(self, document, fields, refresh=None, version=None):
+        """
+        Writes the modified fields of the document into the main index with a partial update,
+        only if the stored document is still at "version", and versions the whole document in the same _bulk request.
+        Failed writes raise as in insert
+        :param document: JSON document, with the content hash in "_meta._hash"
+        :param fields: names of the modified fields of "data"
+        :param refresh: refresh policy ("none", "wait_for" or "immediate"), defaults to the configured policy
+        :param version: version of the stored document the changes are based on
+        :return: Insertion response of the version
+        """
+        uid = document.get('data', {}).get('uid')
+        update_response, version_insert_response = self._write(document, version, refresh, fields)
+        return _get_write_result(uid, version, update_response, version_insert_response)
+
+    def insert_many(self, documents, refresh=None, chunk_size=None, max_chunk_bytes=None):
+        """
+        Inserts and versions many documents, one batch of documents at a time.
+        Each batch costs one _mget for the current documents and one _bulk request writing the main index
+        and the version index together
+        :param documents: iterable of JSON documents
+        :param refresh: refresh policy ("none", "wait_for" or "immediate"), defaults to the configured policy
+        :param chunk_size: maximum number of documents per batch, defaults to the configured size
+        :param max_chunk_bytes: maximum size of a _bulk request body, defaults to the configured size
+        :return: generator of (is_inserted, response) tuples, in the order of the documents
+        """
+        if chunk_size is None:
+            chunk_size = elasticsearch_config.BULK_CHUNK_SIZE
+        self.es_conn.ensure_mapping(elasticsearch_config.INDEX, elasticsearch_config.TYPE)
+        self.es_conn.ensure_versioning_mapping()
+
+        documents = iter(documents)
+        while True:
+            batch = list(islice(documents, chunk_size))
+            if not batch:
+                break
+            for result in self._insert_batch(batch, refresh, chunk_size, max_chunk_bytes):
+                yield result
+
+    def _insert_batch(self, documents, refresh, chunk_size, max_chunk_bytes):
+        uids = [document.get('data').get('uid') for document in documents]
+        # Only the content hashes are fetched to detect unchanged documents
+        current_docs = self.es_conn.get_many(uids,
+                                             elasticsearch_config.INDEX,
+                                             elasticsearch_config.TYPE,
+                                             _source_include='_meta._hash')
+        results = [None] * len(documents)
+
+        actions, changed = _get_batch_actions(documents, current_docs, results)
+        # Two actions per document, a chunk holding the same number of documents as a batch
+        items = self.es_conn.bulk(actions, 2 * chunk_size, max_chunk_bytes, refresh=refresh)
+        batch_repairs = _get_batch_repairs(documents, changed, items)
+
+        repairs = [action for _, _, _, document_repairs in batch_repairs for action in document_repairs]
+        repair_items = self.es_conn.bulk(repairs, chunk_size, max_chunk_bytes, refresh=refresh) if repairs else []
+        _set_batch_results(batch_repairs, repair_items, results)
+        return results
+
+    def delete(self, uid, refresh=None):
+        """
+        Deletes the Entity as well it's all versions, with one update of the main index
+        and one update by query of the version index, whatever the number of versions
         :param uid: uid of the Entity
+        :param refresh: refresh policy ("none", "wait_for" or "immediate"), defaults to the configured policy
         :return: Delete response
         """
-        es_query = elasticsearch_query_builder_util.QueryBuilder.must_match({"uid": uid})
-        res = self.es_conn.get_connection().search(elasticsearch_config.INDEX,
-                                                   elasticsearch_config.TYPE,
-                                                   body=es_query)
-        result_doc_list = res.get('hits', {}).get('hits', [])
-        if len(result_doc_list) == 0:
+        try:
+            self.es_conn.update_one({'script': DELETE_SCRIPT},
+                                    elasticsearch_config.INDEX,
+                                    elasticsearch_config.TYPE,
+                                    uid,
+                                    refresh=refresh,
+                                    retry_on_conflict=3)
+        except elasticsearch.NotFoundError:
             raise Exception('No document found with uid: {}'.format(uid))
-        doc = result_doc_list[0]
-        item = doc.get('_source')
-        item['_meta']['_deleted'] = True
-        insertion_response = self.es_conn.insert_one(item,
-                                                     elasticsearch_config.INDEX,
-                                                     elasticsearch_config.TYPE,
-                                                     item.get('data').get('uid'))
-
-        version_res = self.es_conn.get_connection().search(elasticsearch_config.VERSIONING_INDEX,
-                                                           elasticsearch_config.VERSIONING_TYPE,
-                                                           body=es_query)
-
-        if version_res and isinstance(version_res, dict):
-            for doc in version_res.get('hits', {}).get('hits', []):
-                item = doc.get('_source')
-                item['_meta']['_deleted'] = True
-                _id = doc.get('_id')
-                version_insert_response = self.es_conn.insert_one(item,
-                                                                  elasticsearch_config.VERSIONING_INDEX,
-                                                                  elasticsearch_config.VERSIONING_TYPE,
-                                                                  id=_id)
-                if version_insert_response and isinstance(version_insert_response, dict):
-                    pass
-            return True
-        else:
-            return False
 
-    def get_all_versions(self, id):
+        version_res = self.es_conn.get_connection().update_by_query(elasticsearch_dao.get_versioning_read_index(),
+                                                                    elasticsearch_config.VERSIONING_TYPE,
+                                                                    body=_get_delete_versions_body(uid),
+                                                                    conflicts='proceed',
+                                                                    refresh=_get_by_query_refresh(refresh))
+        return bool(version_res and isinstance(version_res, dict))
+
+    def iter_versions(self, id, page_size=None):
+        """
+        Lazily iterates over the version numbers of a document in ascending order,
+        paging through the version index with search_after
+        :param id: Unique Id of the document
+        :param page_size: number of versions fetched per request, defaults to the configured size
+        :return: generator of version numbers
+        """
+        if page_size is None:
+            page_size = elasticsearch_config.SEARCH_PAGE_SIZE
+        search_after = None
+        while True:
+            res = self.es_conn.get_connection().search(elasticsearch_dao.get_versioning_read_index(),
+                                                       elasticsearch_config.VERSIONING_TYPE,
+                                                       body=_get_versions_query(id, page_size, search_after))
+            versions, search_after = _get_versions_page(res, page_size)
+            for version in versions:
+                yield version
+            if search_after is None:
+                break
+
+    def get_all_versions(self, id, page_size=None):
         """
         Get list of all version numbers
         :param id: Unique Id of the document
-        :return: list of version numbers
+        :param page_size: number of versions fetched per request, defaults to the configured size
+        :return: list of version numbers, in ascending order
         """
-        res = self.es_conn.get_connection().search(elasticsearch_config.VERSIONING_INDEX,
+        return list(self.iter_versions(id, page_size))
+
+    def version_count(self, id):
+        """
+        Number of versions of a document, counted with an aggregation without fetching them
+        :param id: Unique Id of the document
+        :return: <int>
+        """
+        res = self.es_conn.get_connection().search(elasticsearch_dao.get_versioning_read_index(),
                                                    elasticsearch_config.VERSIONING_TYPE,
-                                                   body=elasticsearch_query_builder_util.QueryBuilder.match(
-                                                       {'data.uid': id}))
-        if res and isinstance(res, dict):
-            return [d.get('_source').get('_meta').get('_version') for d in res.get('hits').get('hits')]
-        else:
-            return []
+                                                   body=_get_version_count_query(id))
+        return _get_version_count(res)
 
-    def get_doc_by_version(self, id, version):
+    def get_doc_by_version(self, id, version, last_modified=None):
         """
         Find document by version number
         :param id: Unique ID of the document
         :param version: Version number of the document
+        :param last_modified: modification time of the version (epoch seconds), only the partition of its period
+        being searched when the versions are partitioned
         :return: document as JSON
         """
-        es_query = elasticsearch_query_builder_util.QueryBuilder.must_match(
-            {'uid': id, '_version': version})
-        res = self.es_conn.get_connection().search(elasticsearch_config.VERSIONING_INDEX,
+        res = self.es_conn.get_connection().search(_get_version_search_index(last_modified),
                                                    elasticsearch_config.VERSIONING_TYPE,
-                                                   body=es_query)
-        if res and isinstance(res, dict):
-            doc_list = res.get('hits', {}).get('hits', [])
-            if len(doc_list) == 0:
-                return {}
-            elif len(doc_list) > 1:
-                raise IndexError("Too many values in the list, should be only 1")
-            else:
-                return doc_list[0]
+                                                   body=_get_version_query(id, version))
+        return _get_version_doc(res)
 
     def delete_version(self, id, version):
         """
@@ -147,12 +483,196 @@ class Version(object):
         :param version: version number
         :return: ES Delete response <dict>
         """
-        res = self.es_conn.get_connection().delete_by_query(index=elasticsearch_config.VERSIONING_INDEX,
+        res = self.es_conn.get_connection().delete_by_query(index=elasticsearch_dao.get_versioning_read_index(),
                                                             doc_type=elasticsearch_config.VERSIONING_TYPE,
-                                                            body=elasticsearch_query_builder_util. \
-                                                            QueryBuilder.must_match({'uid': id, '_version': version}))
+                                                            body=_get_version_query(id, version))
         return res
 
+    def get_partitions(self):
+        """
+        Partitions of the version index, from the oldest to the newest
+        :return: <list> of index names, empty when the versions are not partitioned
+        """
+        if elasticsearch_dao.get_partition_format() is None:
+            return []
+        prefix = '{}-'.format(elasticsearch_config.VERSIONING_INDEX)
+        res = self.es_conn.get_connection().indices.get_alias(name=elasticsearch_config.VERSIONING_ALIAS, ignore=404)
+        return sorted(name for name in res if name.startswith(prefix))
+
+    def delete_partitions(self, before):
+        """
+        Deletes the partitions of the version index whose whole period is older than "before",
+        dropping their versions without searching them
+        :param before: epoch seconds
+        :return: <list> of the deleted index names
+        """
+        first_kept = elasticsearch_dao.get_versioning_index(before)
+        expired = [name for name in self.get_partitions() if name < first_kept]
+        if expired:
+            self.es_conn.get_connection().indices.delete(index=','.join(expired))
+            entity_cache = cache.get_cache()
+            # The deleted versions are not known, all the cached documents are dropped
+            if entity_cache is not None:
+                entity_cache.clear()
+        return expired
+
+
+class AsyncVersion(object):
+    """
+    Maintains the versions of the documents with non-blocking requests, see Version
+    """
+
+    def __init__(self):
+        self.es_conn = async_elasticsearch_dao.AsyncElasticsearchDao(
+            elasticsearch_config.HOST,
+            elasticsearch_config.PORT)
+
+    async def _get_doc_by_id(self, id, **params):
+        return await self.es_conn.get_connection().get(index=elasticsearch_config.INDEX, id=id, **params)
+
+    async def _write(self, document, version, refresh, fields=None):
+        """
+        Writes the document and its version with a single _bulk, see Version._write
+        """
+        await self.es_conn.ensure_mapping(elasticsearch_config.INDEX, elasticsearch_config.TYPE)
+        await self.es_conn.ensure_versioning_mapping()
+
+        main_item, version_item = await self.es_conn.bulk(_get_write_actions(document, version, fields),
+                                                          refresh=refresh)
+        repairs = _get_repair_actions(document, main_item, version_item)
+        repair_items = await self.es_conn.bulk(repairs, refresh=refresh) if repairs else []
+        return _get_write_responses(main_item, version_item, repairs, repair_items)
+
+    async def insert(self, document, refresh=None, version=None):
+        """
+        Inserts and versions the document, see Version.insert
+        """
+        uid = document.get('data', {}).get('uid')
+
+        insertion_response, version_insert_response = await self._write(document, version, refresh)
+        if _is_existing_document(version, insertion_response):
+            doc = await self._get_doc_by_id(uid, _source_include='_meta._hash')
+            if _is_unchanged(document, doc):
+                return UNCHANGED_RESULT
+            return await self.insert(document, refresh, doc.get('_version'))
+        return _get_write_result(uid, version, insertion_response, version_insert_response)
+
+    async def update(self, document, fields, refresh=None, version=None):
+        """
+        Writes the modified fields of the document and versions it, see Version.update
+        """
+        uid = document.get('data', {}).get('uid')
+        update_response, version_insert_response = await self._write(document, version, refresh, fields)
+        return _get_write_result(uid, version, update_response, version_insert_response)
+
+    async def insert_many(self, documents, refresh=None, chunk_size=None, max_chunk_bytes=None):
+        """
+        Inserts and versions many documents, one batch of documents at a time, see Version.insert_many
+        :return: async generator of (is_inserted, response) tuples, in the order of the documents
+        """
+        if chunk_size is None:
+            chunk_size = elasticsearch_config.BULK_CHUNK_SIZE
+        await self.es_conn.ensure_mapping(elasticsearch_config.INDEX, elasticsearch_config.TYPE)
+        await self.es_conn.ensure_versioning_mapping()
+
+        documents = iter(documents)
+        while True:
+            batch = list(islice(documents, chunk_size))
+            if not batch:
+                break
+            for result in await self._insert_batch(batch, refresh, chunk_size, max_chunk_bytes):
+                yield result
+
+    async def _insert_batch(self, documents, refresh, chunk_size, max_chunk_bytes):
+        uids = [document.get('data').get('uid') for document in documents]
+        current_docs = await self.es_conn.get_many(uids,
+                                                   elasticsearch_config.INDEX,
+                                                   elasticsearch_config.TYPE,
+                                                   _source_include='_meta._hash')
+        results = [None] * len(documents)
+
+        actions, changed = _get_batch_actions(documents, current_docs, results)
+        items = await self.es_conn.bulk(actions, 2 * chunk_size, max_chunk_bytes, refresh=refresh)
+        batch_repairs = _get_batch_repairs(documents, changed, items)
+
+        repairs = [action for _, _, _, document_repairs in batch_repairs for action in document_repairs]
+        repair_items = await self.es_conn.bulk(repairs, chunk_size, max_chunk_bytes,
+                                               refresh=refresh) if repairs else []
+        _set_batch_results(batch_repairs, repair_items, results)
+        return results
+
+    async def delete(self, uid, refresh=None):
+        """
+        Deletes the Entity as well it's all versions, see Version.delete
+        """
+        try:
+            await self.es_conn.update_one({'script': DELETE_SCRIPT},
+                                          elasticsearch_config.INDEX,
+                                          elasticsearch_config.TYPE,
+                                          uid,
+                                          refresh=refresh,
+                                          retry_on_conflict=3)
+        except elasticsearch.NotFoundError:
+            raise Exception('No document found with uid: {}'.format(uid))
+
+        version_res = await self.es_conn.get_connection().update_by_query(elasticsearch_dao.get_versioning_read_index(),
+                                                                          elasticsearch_config.VERSIONING_TYPE,
+                                                                          body=_get_delete_versions_body(uid),
+                                                                          conflicts='proceed',
+                                                                          refresh=_get_by_query_refresh(refresh))
+        return bool(version_res and isinstance(version_res, dict))
+
+    async def iter_versions(self, id, page_size=None):
+        """
+        Lazily iterates over the version numbers of a document in ascending order, see Version.iter_versions
+        :return: async generator of version numbers
+        """
+        if page_size is None:
+            page_size = elasticsearch_config.SEARCH_PAGE_SIZE
+        search_after = None
+        while True:
+            res = await self.es_conn.get_connection().search(elasticsearch_dao.get_versioning_read_index(),
+                                                             elasticsearch_config.VERSIONING_TYPE,
+                                                             body=_get_versions_query(id, page_size, search_after))
+            versions, search_after = _get_versions_page(res, page_size)
+            for version in versions:
+                yield version
+            if search_after is None:
+                break
+
+    async def get_all_versions(self, id, page_size=None):
+        """
+        Get list of all version numbers, see Version.get_all_versions
+        """
+        return [version async for version in self.iter_versions(id, page_size)]
+
+    async def version_count(self, id):
+        """
+        Number of versions of a document, see Version.version_count
+        """
+        res = await self.es_conn.get_connection().search(elasticsearch_dao.get_versioning_read_index(),
+                                                         elasticsearch_config.VERSIONING_TYPE,
+                                                         body=_get_version_count_query(id))
+        return _get_version_count(res)
+
+    async def get_doc_by_version(self, id, version, last_modified=None):
+        """
+        Find document by version number, see Version.get_doc_by_version
+        """
+        res = await self.es_conn.get_connection().search(_get_version_search_index(last_modified),
+                                                         elasticsearch_config.VERSIONING_TYPE,
+                                                         body=_get_version_query(id, version))
+        return _get_version_doc(res)
+
+    async def delete_version(self, id, version):
+        """
+        Deletes a version of document, see Version.delete_version
+        """
+        return await self.es_conn.get_connection().delete_by_query(
+            index=elasticsearch_dao.get_versioning_read_index(),
+            doc_type=elasticsearch_config.VERSIONING_TYPE,
+            body=_get_version_query(id, version))
+
 
 if __name__ == '__main__':
     # print(Version().insert({"data": {"uid": "person1", "name": "Mayank Chutani"},
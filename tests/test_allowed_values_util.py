@@ -0,0 +1,152 @@
+import itertools
+import json
+import os
+import random
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from esorm.util import http_request_util
+from esorm.util.allowed_values_util import AllowedValues, AllowedMultiset, AllowedValuesProvider
+
+
+def linear_contains(allowed_values, value):
+    """
+    Linear check of the numeric properties the compiled values replace: discrete values and (lower, upper) ranges
+    """
+    if value in allowed_values:
+        return True
+    for item in allowed_values:
+        if isinstance(item, tuple) and item[0] <= value <= item[1]:
+            return True
+    return False
+
+
+def linear_multiset_contains(allowed_values, value):
+    """
+    Linear check of the array properties the compiled multiset replaces
+    """
+    return sorted(value) == sorted(allowed_values)
+
+
+class AllowedValuesTest(unittest.TestCase):
+
+    def assertSameAnswers(self, allowed_values, values):
+        compiled = AllowedValues(allowed_values, ranges=True)
+        for value in values:
+            self.assertEqual(value in compiled, linear_contains(allowed_values, value),
+                             '{!r} in {!r}'.format(value, allowed_values))
+
+    def test_discrete_values(self):
+        self.assertSameAnswers([1, 5, 9], range(-2, 12))
+        self.assertSameAnswers([0.5, 2.25], [0.5, 0.75, 2.25, 2.5, 1, 2])
+
+    def test_bounds(self):
+        self.assertSameAnswers([(1, 5)], [0, 1, 5, 6, 0.999, 1.0, 5.0, 5.001])
+        self.assertSameAnswers([(2.5, 2.5)], [2, 2.5, 3])
+        # Empty range
+        self.assertSameAnswers([(5, 1)], range(0, 7))
+
+    def test_overlapping_ranges(self):
+        self.assertSameAnswers([(1, 5), (3, 8)], range(-1, 11))
+        self.assertSameAnswers([(1, 10), (3, 4)], range(-1, 12))
+        self.assertSameAnswers([(3, 8), (1, 5), (7, 12), (20, 30)], [x / 2 for x in range(0, 70)])
+
+    def test_adjacent_ranges(self):
+        self.assertSameAnswers([(1, 3), (3, 6)], [0, 1, 2.5, 3, 3.5, 6, 7])
+        self.assertSameAnswers([(1, 3), (4, 6)], [0, 1, 3, 3.5, 4, 6, 7])
+
+    def test_values_and_ranges(self):
+        self.assertSameAnswers([0, (1, 3), 5, (10, 20), 25, (4.5, 5.5)], [x / 2 for x in range(-2, 60)])
+
+    def test_unhashable_values(self):
+        allowed_values = [[1, 2], {'a': 1}, 'a']
+        compiled = AllowedValues(allowed_values)
+        for value in ([1, 2], [2, 1], {'a': 1}, {'a': 2}, 'a', 'b', 1):
+            self.assertEqual(value in compiled, value in allowed_values, repr(value))
+
+    def test_random(self):
+        generator = random.Random(5)
+        for _ in range(200):
+            allowed_values = []
+            for _ in range(generator.randint(1, 8)):
+                if generator.random() < 0.5:
+                    allowed_values.append(generator.randint(-20, 20))
+                else:
+                    lower = generator.randint(-20, 20)
+                    allowed_values.append((lower, lower + generator.randint(-2, 10)))
+            self.assertSameAnswers(allowed_values, [x / 2 for x in range(-50, 70)])
+
+    def test_empty(self):
+        self.assertFalse(AllowedValues([]))
+        self.assertFalse(AllowedValues(None))
+        self.assertTrue(AllowedValues([(1, 2)], ranges=True))
+
+
+class AllowedMultisetTest(unittest.TestCase):
+
+    def assertSameAnswers(self, allowed_values, values):
+        compiled = AllowedMultiset(allowed_values)
+        for value in values:
+            self.assertEqual(value in compiled, linear_multiset_contains(allowed_values, value),
+                             '{!r} in {!r}'.format(value, allowed_values))
+
+    def test_same_items_in_any_order(self):
+        allowed_values = ['a', 'b', 'b', 'c']
+        self.assertSameAnswers(allowed_values, [list(value) for value in itertools.permutations(allowed_values)])
+        self.assertSameAnswers(allowed_values, [['a', 'b', 'c'], ['a', 'b', 'c', 'c'], ['a', 'b', 'b', 'c', 'c'], []])
+
+    def test_numbers(self):
+        self.assertSameAnswers([1, 2.5, 2], [[2, 1, 2.5], [2.5, 2.0, 1.0], [1, 2, 2], [1, 2.5]])
+
+    def test_unhashable_items(self):
+        allowed_values = [[1, 2], [0], [1, 2]]
+        self.assertSameAnswers(allowed_values, [[[0], [1, 2], [1, 2]], [[1, 2], [0], [0]], [[0], [1, 2]],
+                                                [[2, 1], [0], [1, 2]]])
+        # Unhashable items in the value only
+        self.assertSameAnswers([1, 2], [[[1], [2]], [[1, 2], [3]]])
+
+
+class AllowedValuesProviderTest(unittest.TestCase):
+
+    def setUp(self):
+        snapshot_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(snapshot_dir.cleanup)
+        self.snapshot_dir = os.path.join(snapshot_dir.name, 'allowed_values')
+        self.release = threading.Event()
+        self.urls = []
+
+    def make_get_request(self, url, params=None, headers=None, timeout=None):
+        self.urls.append(url)
+        self.release.wait(5)
+        return mock.Mock(status_code=200, content=json.dumps({'allowed_values': ['a', 'b']}), headers={})
+
+    def test_concurrent_first_calls(self):
+        provider = AllowedValuesProvider('http://localhost/values', snapshot_dir=self.snapshot_dir)
+        results = []
+        with mock.patch.object(http_request_util, 'make_get_request', side_effect=self.make_get_request):
+            threads = [threading.Thread(target=lambda: results.append(provider.get())) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            self.release.set()
+            for thread in threads:
+                thread.join(5)
+
+        self.assertEqual(self.urls, ['http://localhost/values'])
+        self.assertEqual(results, [(['a', 'b'], 1)] * 4)
+        self.assertEqual(os.stat(self.snapshot_dir).st_mode & 0o777, 0o700)
+
+    def test_snapshot_when_unreachable(self):
+        provider = AllowedValuesProvider('http://localhost/values', snapshot_dir=self.snapshot_dir)
+        self.release.set()
+        with mock.patch.object(http_request_util, 'make_get_request', side_effect=self.make_get_request):
+            provider.get()
+
+        provider = AllowedValuesProvider('http://localhost/values', snapshot_dir=self.snapshot_dir)
+        with mock.patch.object(http_request_util, 'make_get_request', side_effect=IOError('unreachable')):
+            self.assertEqual(provider.get(), (['a', 'b'], 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
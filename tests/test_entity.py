@@ -0,0 +1,76 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from esorm.dao import async_elasticsearch_dao
+from esorm.entity import StructuredEntity, AsyncQuerySet
+from esorm.properties import UniqueIdProperty, StringProperty, ArrayProperty, JsonObjectProperty
+
+
+class Person(StructuredEntity):
+    uid = UniqueIdProperty()
+    name = StringProperty(default='anonymous')
+    phones = ArrayProperty(base_property=StringProperty())
+    settings = JsonObjectProperty()
+
+
+class EntityTest(unittest.TestCase):
+
+    def test_unset_fields(self):
+        first = Person()
+        self.assertIsNone(first.uid)
+        self.assertIsNone(first.name)
+        self.assertIsNone(first.phones)
+        self.assertIsNone(first.settings)
+        self.assertNotIn('phones', first.value_dict)
+
+    def test_values_per_instance(self):
+        first, second = Person(uid='first'), Person(uid='second')
+        first.phones = ['1']
+        first.phones.append('2')
+
+        self.assertEqual(first.phones, ['1', '2'])
+        self.assertIsNone(second.phones)
+        self.assertEqual(Person.phones.default, [])
+        self.assertEqual((first.uid, second.uid), ('first', 'second'))
+
+
+class AsyncQuerySetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+        patcher = mock.patch.object(async_elasticsearch_dao.AsyncElasticsearch, 'perform_request', autospec=True,
+                                    side_effect=self.perform_request)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def perform_request(self, client, method, path, params=None, body=None):
+        self.requests.append((path, params))
+        if path.endswith('/_count'):
+            return {'count': 7}
+        hits = [{'_version': 1, '_source': {'data': {'uid': uid, 'name': 'John'}}} for uid in ('a', 'b')]
+        return {'hits': {'total': 2, 'hits': hits[:params.get('size', 2)]}}
+
+    def test_async_evaluation(self):
+        query_set = Person.async_entities().filter(name='John').order_by('uid')
+        self.assertIsInstance(query_set, AsyncQuerySet)
+        self.assertIsInstance(query_set[:1], AsyncQuerySet)
+
+        async def evaluate():
+            return ([person.uid async for person in query_set], await query_set.acount(),
+                    await query_set.exclude(uid='b').acount(), await query_set.aexists())
+
+        self.assertEqual(asyncio.run(evaluate()), (['a', 'b'], 2, 7, True))
+        # The fetched results are counted without request, unlike a new query
+        self.assertEqual([path for path, _ in self.requests], ['/orm/entity/_search', '/orm/entity/_count'])
+
+    def test_blocking_evaluation(self):
+        query_set = Person.async_entities().all()
+        for evaluate in (list, len, lambda query_set: query_set[0], AsyncQuerySet.count, AsyncQuerySet.exists):
+            with self.assertRaises(TypeError):
+                evaluate(query_set)
+        self.assertEqual(self.requests, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+
+from esorm.retention import RetentionPolicy
+
+NOW = 1000
+
+
+def get_versions(*last_modified):
+    """
+    :return: <list> of (version number, last modified, key) of versions 1, 2... keyed by their number
+    """
+    return [(version, modified, version) for version, modified in enumerate(last_modified, start=1)]
+
+
+class RetentionPolicyTest(unittest.TestCase):
+
+    def assertExpired(self, policy, versions, expected):
+        self.assertEqual(sorted(policy.get_expired(versions, now=NOW)), expected)
+
+    def test_latest_version_only(self):
+        self.assertExpired(RetentionPolicy(), get_versions(100, 200, 300, 400), [1, 2, 3])
+
+    def test_keep_last(self):
+        versions = get_versions(100, 200, 300, 400, 500, 600)
+        self.assertExpired(RetentionPolicy(keep_last=3), versions, [1, 2, 3])
+        self.assertExpired(RetentionPolicy(keep_last=1), versions, [1, 2, 3, 4, 5])
+        self.assertExpired(RetentionPolicy(keep_last=10), versions, [])
+
+    def test_keep_for(self):
+        versions = get_versions(100, 500, 899, 900, 950)
+        # Versions modified keep_for seconds ago are still kept
+        self.assertExpired(RetentionPolicy(keep_for=100), versions, [1, 2, 3])
+        self.assertExpired(RetentionPolicy(keep_for=1000), versions, [])
+
+    def test_keep_for_latest_version_kept(self):
+        # The latest version is kept however old it is
+        self.assertExpired(RetentionPolicy(keep_for=10), get_versions(100, 200, 300), [1, 2])
+        self.assertExpired(RetentionPolicy(keep_for=0), get_versions(100), [])
+
+    def test_thin_interval(self):
+        # Periods of 100 seconds: [0, 100) holds versions 1 and 2, [100, 200) versions 3 and 4, [200, 300) version 5
+        versions = get_versions(10, 50, 150, 160, 250)
+        self.assertExpired(RetentionPolicy(thin_interval=100), versions, [1, 3])
+
+    def test_thin_interval_bounds(self):
+        # 100 starts the second period, 99.5 ends the first one
+        versions = get_versions(0, 99.5, 100, 199)
+        self.assertExpired(RetentionPolicy(thin_interval=100), versions, [1, 3])
+
+    def test_keep_last_and_thin_interval(self):
+        versions = get_versions(10, 50, 150, 160, 250, 260)
+        # Versions 5 and 6 are the latest ones, version 5 being the one of the [200, 300) period
+        self.assertExpired(RetentionPolicy(keep_last=2, thin_interval=100), versions, [1, 3])
+
+    def test_keep_for_and_thin_interval(self):
+        versions = get_versions(10, 50, 150, 160, 920, 950, 990)
+        # Versions 5 to 7 are kept for their age, older ones are thinned to one per period
+        self.assertExpired(RetentionPolicy(keep_for=100, thin_interval=100), versions, [1, 3])
+
+    def test_combined(self):
+        versions = get_versions(10, 20, 120, 130, 900, 990)
+        # Version 6 is kept for its age, version 5 as one of the 2 latest versions, versions 4 and 2 for their period
+        self.assertExpired(RetentionPolicy(keep_last=2, keep_for=50, thin_interval=100), versions, [1, 3])
+        # Without thinning, only the latest and recent versions are kept
+        self.assertExpired(RetentionPolicy(keep_last=2, keep_for=50), versions, [1, 2, 3, 4])
+
+    def test_unordered_versions(self):
+        versions = list(reversed(get_versions(10, 50, 150, 160, 250)))
+        self.assertExpired(RetentionPolicy(thin_interval=100), versions, [1, 3])
+        # Versions without modification time are in the first period
+        self.assertExpired(RetentionPolicy(thin_interval=100), [(1, None, 1), (2, 20, 2), (3, 150, 3)], [1])
+
+    def test_invalid_policy(self):
+        with self.assertRaises(ValueError):
+            RetentionPolicy(keep_last=0)
+        with self.assertRaises(ValueError):
+            RetentionPolicy(thin_interval=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+import json
+import unittest
+from unittest import mock
+
+import elasticsearch
+
+from esorm.entity import StructuredEntity
+from esorm.config import elasticsearch_config
+from esorm.properties import UniqueIdProperty, StringProperty, IntegerProperty, ArrayProperty
+
+
+class Person(StructuredEntity):
+    uid = UniqueIdProperty()
+    name = StringProperty()
+    age = IntegerProperty()
+    phones = ArrayProperty(base_property=StringProperty())
+
+
+class StubTransport(object):
+    """
+    Answers the requests of the elasticsearch client like a cluster only holding the documents written with _bulk,
+    recording the requests. Only the transport is stubbed, the bodies being built by the client as they are sent
+    to elasticsearch
+    """
+
+    def __init__(self):
+        self.requests = []
+        # (version, source) of the stored documents by (index, id)
+        self.documents = {}
+        # Status of the _bulk actions failing on an index, by index
+        self.failures = {}
+
+    def perform_request(self, transport, method, url, params=None, body=None):
+        self.requests.append((method, url, body))
+        if url.endswith('/_bulk'):
+            return {'errors': False, 'items': self._bulk_items(body)}
+        if url.endswith('/_mget'):
+            index = url.split('/')[1]
+            return {'docs': [self._get(index, id) for id in body.get('ids', [])]}
+        if url.endswith('/_search'):
+            return {'hits': {'total': 0, 'hits': []}}
+        return {'acknowledged': True}
+
+    def _get(self, index, id):
+        if (index, id) not in self.documents:
+            return {'_index': index, '_id': id, 'found': False}
+        version, source = self.documents[(index, id)]
+        return {'_index': index, '_id': id, '_version': version, 'found': True, '_source': json.loads(source)}
+
+    def _bulk_items(self, body):
+        if not isinstance(body, str) or not body.endswith('\n'):
+            raise AssertionError('_bulk body must be a str ending with a newline, found {!r}'.format(body))
+        lines = iter(body.splitlines())
+        items = []
+        for line in lines:
+            op_type, action = next(iter(json.loads(line).items()))
+            source = None if op_type == 'delete' else json.loads(next(lines))
+            items.append({op_type: self._write(op_type, action, source)})
+        return items
+
+    def _write(self, op_type, action, source):
+        key = (action.get('_index'), action.get('_id'))
+        item = {'_index': key[0], '_type': action.get('_type'), '_id': key[1]}
+        if key[0] in self.failures:
+            item.update(status=self.failures[key[0]], error={'type': 'security_exception'})
+            return item
+        stored_version, stored_source = self.documents.get(key, (0, None))
+        if op_type == 'create' and stored_source is not None \
+                or '_version' in action and action['_version'] != stored_version:
+            item.update(status=409, error={'type': 'version_conflict_engine_exception'})
+            return item
+        if op_type == 'update':
+            # The partial update script of versioning puts the params into "data" and "_meta"
+            params = source['script']['params']
+            source = json.loads(stored_source)
+            source['data'].update(params['data'])
+            source['_meta'].update(params['meta'])
+        if op_type == 'delete':
+            self.documents.pop(key, None)
+        else:
+            self.documents[key] = (stored_version + 1, json.dumps(source))
+        item.update(_version=stored_version + 1, result='created', status=201)
+        return item
+
+    def stored_data(self, index, id):
+        return json.loads(self.documents[(index, id)][1])['data']
+
+    def bulk_requests(self):
+        return [body for method, url, body in self.requests if url.endswith('/_bulk')]
+
+
+class SaveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.transport = StubTransport()
+        patcher = mock.patch.object(elasticsearch.Transport, 'perform_request', autospec=True,
+                                    side_effect=self.transport.perform_request)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_save(self):
+        person = Person(uid='jdoe', name='John', age=30)
+        self.assertTrue(person.save())
+        self.assertEqual(person._version, 1)
+        bulk_requests = self.transport.bulk_requests()
+        self.assertEqual(len(bulk_requests), 1)
+        # The document and its version are written by the same request
+        self.assertEqual(len(bulk_requests[0].splitlines()), 4)
+        self.assertIn('"jdoe"', bulk_requests[0])
+
+    def test_save_many(self):
+        people = [Person(uid='uid{}'.format(i), name='name{}'.format(i), age=i) for i in range(5)]
+        results = Person.save_many(people)
+
+        self.assertEqual([is_saved for is_saved, _ in results], [True] * 5)
+        self.assertEqual(len(self.transport.bulk_requests()), 1)
+
+    def test_save_version_failed(self):
+        self.transport.failures[elasticsearch_config.VERSIONING_INDEX] = 403
+        person = Person(uid='jdoe', name='John')
+
+        with self.assertRaises(elasticsearch.exceptions.AuthorizationException):
+            person.save()
+        # The version was written again by the repair _bulk, failing as well
+        self.assertEqual(len(self.transport.bulk_requests()), 2)
+        self.assertEqual(self.transport.stored_data(elasticsearch_config.INDEX, 'jdoe')['name'], 'John')
+        self.assertIsNone(person._version)
+
+    def test_save_changed_in_place(self):
+        Person(uid='jdoe', name='John', phones=['1']).save()
+        person = Person.entities().get_by_uid('jdoe')
+
+        # Changed in place then with set_value: both fields are written by the partial update
+        person.phones.append('2')
+        person.set_value('name', 'Jane')
+        self.assertTrue(person.save())
+        self.assertEqual(self.transport.stored_data(elasticsearch_config.INDEX, 'jdoe'),
+                         {'uid': 'jdoe', 'name': 'Jane', 'phones': ['1', '2']})
+
+        # Only changed in place, after a save
+        person.phones.append('3')
+        self.assertTrue(person.save())
+        self.assertEqual(self.transport.stored_data(elasticsearch_config.INDEX, 'jdoe')['phones'], ['1', '2', '3'])
+
+        reloaded = Person.entities().get_by_uid('jdoe')
+        self.assertEqual(reloaded.phones, ['1', '2', '3'])
+        self.assertEqual(reloaded._hash, person._hash)
+        self.assertFalse(reloaded.save())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+
+import elasticsearch
+
+from esorm import versioning
+from esorm.config import elasticsearch_config
+from esorm.exception import VersionConflictError
+
+
+def get_document(version):
+    return {'data': {'uid': 'jdoe', 'name': 'John'}, '_meta': {'_version': version, '_hash': 'hash'}}
+
+
+def get_version_action(op_type, version, **meta):
+    action = {'_index': elasticsearch_config.VERSIONING_INDEX, '_type': elasticsearch_config.VERSIONING_TYPE,
+              '_id': 'jdoe_{}'.format(version)}
+    action.update(meta)
+    return {op_type: action}
+
+
+class RepairActionsTest(unittest.TestCase):
+    """
+    Repairs of the version index after the _bulk of _get_write_actions, predicting version 3 of "jdoe"
+    """
+
+    def setUp(self):
+        self.document = get_document(3)
+        self.version_created = {'create': {'_index': elasticsearch_config.VERSIONING_INDEX, '_version': 1,
+                                           'status': 201}}
+        self.version_rejected = {'create': {'_index': elasticsearch_config.VERSIONING_INDEX, 'status': 409,
+                                            'error': {'type': 'version_conflict_engine_exception'}}}
+
+    def test_no_repair(self):
+        main_item = {'update': {'_version': 3, 'status': 200}}
+        self.assertEqual(versioning._get_repair_actions(self.document, main_item, self.version_created), [])
+        self.assertEqual(self.document['_meta']['_version'], 3)
+
+    def test_main_write_conflict(self):
+        main_item = {'update': {'status': 409, 'error': {'type': 'version_conflict_engine_exception'}}}
+        repairs = versioning._get_repair_actions(self.document, main_item, self.version_created)
+
+        # The version of the failed write is deleted, unless written again meanwhile
+        self.assertEqual(repairs, [(get_version_action('delete', 3, _version=1), None)])
+        self.assertEqual(self.document['_meta']['_version'], 3)
+
+    def test_version_create_failed(self):
+        main_item = {'update': {'_version': 3, 'status': 200}}
+        repairs = versioning._get_repair_actions(self.document, main_item, self.version_rejected)
+
+        self.assertEqual(repairs, [(get_version_action('index', 3), self.document)])
+
+    def test_other_version(self):
+        # A concurrent save wrote the main index in between, the version is 5 instead of 3
+        main_item = {'index': {'_version': 5, 'status': 200}}
+        repairs = versioning._get_repair_actions(self.document, main_item, self.version_created)
+
+        self.assertEqual(repairs, [(get_version_action('delete', 3, _version=1), None),
+                                   (get_version_action('index', 5), self.document)])
+        self.assertEqual(self.document['_meta']['_version'], 5)
+
+    def test_other_version_create_failed(self):
+        main_item = {'index': {'_version': 5, 'status': 200}}
+        repairs = versioning._get_repair_actions(self.document, main_item, self.version_rejected)
+
+        self.assertEqual(repairs, [(get_version_action('index', 5), self.document)])
+
+    def test_write_responses(self):
+        main_item = {'index': {'_version': 5, 'status': 200}}
+        repairs = versioning._get_repair_actions(self.document, main_item, self.version_created)
+        repair_items = [{'delete': {'status': 200}}, {'index': {'_version': 1, 'status': 201}}]
+
+        # The version response is the one of the last write of the version
+        self.assertEqual(versioning._get_write_responses(main_item, self.version_created, repairs, repair_items),
+                         (main_item['index'], repair_items[1]['index']))
+
+
+class WriteResultTest(unittest.TestCase):
+
+    def test_version_failed(self):
+        version_response = {'status': 403, 'error': {'type': 'security_exception'}}
+        with self.assertRaises(elasticsearch.exceptions.AuthorizationException):
+            versioning._get_write_result('jdoe', 2, {'_version': 3, 'status': 200}, version_response)
+
+    def test_main_conflict(self):
+        with self.assertRaises(VersionConflictError):
+            versioning._get_write_result('jdoe', 2, {'status': 409, 'error': {}}, {'status': 201})
+
+    def test_written(self):
+        self.assertEqual(versioning._get_write_result('jdoe', 2, {'_version': 3, 'status': 200}, {'status': 201}),
+                         (True, {'status': 201}))
+
+
+if __name__ == '__main__':
+    unittest.main()